@@ -1,56 +1,168 @@
 import os
+import math
 from flask import Flask,render_template, request, jsonify,make_response,redirect,url_for, g
-import json
-import bcrypt
-from core.db import Database
-import jwt
+from werkzeug.middleware.proxy_fix import ProxyFix
+from core import rhythm
+from core.assets import AssetCache
+from core.availability import AvailabilityIndex
+from core.db import open_database
+from core.hashing import Hasher, HashingBusy
+from core.metrics import Metrics
+from core.cli import users_cli
+from core.throttle import Throttle, store_from_env
+from core.tokens import ACCESS_COOKIE, REFRESH_COOKIE, TokenService
 from dotenv import load_dotenv
 
 load_dotenv()
 
 app = Flask(__name__, template_folder="templates")
 
-db = Database()
+# Heroku's router and Vercel's edge put the client address in
+# X-Forwarded-For; trust that many hops of it so request.remote_addr (and the
+# per-address throttles keyed on it) is the client, not the proxy. Leave it
+# at 0 when clients connect directly, or they could pick their own address.
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", 1 if os.getenv("VERCEL") == "1" or os.getenv("DYNO") else 0))
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS, x_proto=TRUSTED_PROXY_HOPS)
+
+# FAST_START defers opening the database, calibrating bcrypt and building
+# the asset cache to the first request that needs them. On by default on
+# Vercel, where every cold start is paid by a user request.
+FAST_START = os.getenv("FAST_START", "1" if os.getenv("VERCEL") == "1" else "0") == "1"
+
+db = open_database(lazy=FAST_START)
+hasher = Hasher(lazy=FAST_START)
+
+# Per-request phase timings (jwt, db, bcrypt, render) for /metrics; set up
+# before the middleware below so the whole request is measured
+metrics = Metrics.from_env()
+metrics.init_app(app)
+metrics.instrument(db, [
+    "add_user", "get_user_by_id", "get_user_by_username", "taken",
+    "update_user_password", "update_user_with_password", "update_user_without_password",
+    "session_generation", "bump_session_generation", "revoke_refresh_token",
+], phase="db", metric="snapbeat_db_query_seconds")
+metrics.instrument(hasher, ["hash", "check"], phase="bcrypt", metric="snapbeat_bcrypt_seconds")
+metrics.gauge("snapbeat_bcrypt_queue_depth", lambda: hasher.queue_depth)
+
+# Login attempts are limited per client address and per username before any
+# lookup or hashing happens, so failed guesses cannot monopolise bcrypt. The
+# username limit only counts failed attempts, so a user's own logins never
+# use it up.
+throttle_store = store_from_env()
+login_ip_throttle = Throttle(throttle_store, int(os.getenv("LOGIN_IP_PER_MINUTE", 30)), prefix="login-ip:")
+login_user_throttle = Throttle(throttle_store, int(os.getenv("LOGIN_USER_PER_MINUTE", 10)), prefix="login-user:")
+available_ip_throttle = Throttle(throttle_store, int(os.getenv("AVAILABLE_IP_PER_MINUTE", 120)), prefix="available-ip:")
+
+# Which usernames and emails are taken, so signup can turn duplicates away
+# before hashing and the signup form can check names as they are typed
+availability = AvailabilityIndex(db, lazy=FAST_START)
+
+# Shared with the `flask users ...` commands
+app.extensions["db"] = db
+app.extensions["hasher"] = hasher
+app.cli.add_command(users_cli)
 
 SECRET = os.getenv("SECRET")
+
+# Short-lived access tokens that carry the user's id, username and email,
+# renewed from a refresh token; see core/tokens.py
+tokens = TokenService(SECRET, db)
+for stat in ("entries", "bytes", "hits", "misses", "evictions"):
+    metrics.gauge(f"snapbeat_token_cache_{stat}", lambda stat=stat: tokens.verified.stats()[stat])
  
 ####################################### 
 #              MideleWares            #
 #      protecr some special pages     #
 #######################################
 
+def skip_user_lookup(view):
+    # Mark a view that never reads g.user, so check_authentication does not
+    # decode the token or load the user for it
+    view.skip_user_lookup = True
+    return view
+
+
 @app.before_request
 def check_authentication():
     protected_paths = ['/account','/edit-profile','/change-password']
     g.user = None
-    token = request.cookies.get('token')
 
+    # Static files, unknown urls and views marked with skip_user_lookup
+    view = app.view_functions.get(request.endpoint)
+    if request.endpoint == "static" or view is None or getattr(view, "skip_user_lookup", False):
+        return
+
+    g.claims = None
+    token = request.cookies.get(ACCESS_COOKIE)
     if token:
-        try:
-            user_data = jwt.decode(token.encode('utf-8'), SECRET, algorithms=["HS256"])
-            g.user = db.get_user_by_id(user_data['id'])
-        except (jwt.exceptions.DecodeError, KeyError):
-            # Invalid token or missing 'id'
-            pass
+        with metrics.phase("jwt"):
+            g.claims = tokens.verify_access(token)
+
+    refresh_token = request.cookies.get(REFRESH_COOKIE)
+    if g.claims is None and refresh_token:
+        # Access token expired (or missing): swap the refresh token for a
+        # new pair, set on the response by set_refreshed_tokens
+        with metrics.phase("jwt"):
+            user = tokens.refresh(refresh_token)
+        if user:
+            g.claims = {"id": user[0], "username": user[1], "email": user[2], "gen": db.session_generation(user[0])}
+            g.refreshed = True
+
+    if g.claims:
+        # Everything pages need is in the token, so no database lookup
+        g.user = (g.claims["id"], g.claims["username"], g.claims["email"])
 
     if request.path in protected_paths and not g.user:
         res = make_response(redirect(url_for('login_page')))
-        res.delete_cookie("token")
+        tokens.delete_cookies(res)
         return res
+
+
+@app.after_request
+def set_refreshed_tokens(response):
+    if g.get("refreshed"):
+        tokens.set_cookies(response, *g.user, g.claims["gen"])
+    return response
+
+
+def issue_tokens(response, user_id, username, email, gen):
+    # Takes the place of any pair set_refreshed_tokens would have issued
+    g.refreshed = False
+    return tokens.set_cookies(response, user_id, username, email, gen)
           
-          
+
+@app.errorhandler(HashingBusy)
+def hashing_busy(e):
+    # Every bcrypt slot is taken; shed the request instead of queueing it.
+    # Retry goes back to the form, as the /auth endpoints only take POSTs.
+    form_page = url_for('signup_page') if request.endpoint == "signup" else url_for('login_page')
+    res = make_response(render_template("auth/err.html", message="Server is busy, please try again in a moment.", naviagte= form_page,naviagte_msg = "Retry"), 503)
+    res.headers["Retry-After"] = "1"
+    return res
+
+
+# Pages whose html never changes are rendered once and served from memory
+# (with the static folder) by the asset cache
+assets = AssetCache(app, lazy=FAST_START)
+assets.prerender("index.html", "signup.html", "login.html", "change-password.html")
+
+
 @app.route("/")
+@skip_user_lookup
 def index():
-    return render_template("index.html")
+    return assets.page("index.html")
 
 @app.route("/signup")
+@skip_user_lookup
 def signup_page():
-    return render_template("signup.html")
+    return assets.page("signup.html")
 
 
 @app.route("/login")
+@skip_user_lookup
 def login_page():
-    return render_template("login.html")
+    return assets.page("login.html")
 
 
 @app.route("/account")
@@ -58,6 +170,7 @@ def account_page():
     if g.user:
         response = make_response(render_template("account.html", username=g.user[1], email=g.user[2]))
         response.headers["Content-Type"] = "text/html; charset=utf-8"
+        response.headers["Cache-Control"] = "no-store"
         return response
     return redirect(url_for('login_page'))
  
@@ -66,35 +179,24 @@ def account_page():
  
 
 @app.route("/auth/signup", methods=["POST"])
+@skip_user_lookup
 def signup():
  
     username = request.form["username"]
     email = request.form["email"]
     
-    # note
-    pattern = json.loads(request.form["rhythmPattern"])
-    
-     
-    
-    passString = ""
-    for note in pattern:
-        passString += note["note"]
-    
-    password = passString  
-    
-    # password convert to  hash code 
-    
-    
-    # password turn to bytes
-    bytes_password = password.encode("utf-8")
-    
-    # generate salt 
-    
-    salt = bcrypt.gensalt()
+    # note -> compact password bytes (one byte per beat)
+    try:
+        password = rhythm.parse(request.form["rhythmPattern"])
+    except rhythm.RhythmError as e:
+        return render_template("auth/err.html", message=str(e), naviagte= "/signup",naviagte_msg = "please Retry"), 400
+
+    if any(availability.taken(username, email)):
+        return render_template("auth/err.html", message="User already exist", naviagte= "/signup",naviagte_msg = "please Retry")
     
-    # use bytepass and salt genrate hased passord 
+    # genrate hased passord (salt and cost are handled by the hasher)
     
-    hashed_password = bcrypt.hashpw(bytes_password,salt)
+    hashed_password = rhythm.stored_hash(hasher.hash(password))
     # save user in database 
     db_res = db.add_user(username, email, hashed_password)
     
@@ -102,65 +204,103 @@ def signup():
         # //retun erro page with say user a leard exists
         return render_template("auth/err.html", message="User already exist", naviagte= "/signup",naviagte_msg = "please Retry")
     if db_res:
-        # create jwt token 
-        token = jwt.encode({"id":db_res[0],"username":db_res[1]},SECRET,algorithm="HS256")
-        
+        availability.add(username, email)
+        # create access and refresh tokens
         res = make_response(render_template("auth/success.html", message="User created successfully."))
-        res.set_cookie("token",token)
+        issue_tokens(res, db_res[0], db_res[1], db_res[2], db.session_generation(db_res[0]))
     
         # return a page show suuce registrayon and redirect to /acc  page 
         return res
     else:
         return render_template("auth/err.html", message="User didn't create, please try again." , naviagte= "/signup",naviagte_msg = "please Retry")
 
+@app.route("/auth/available")
+@skip_user_lookup
+def available():
+    # ?username=...&email=... -> {"username": true, "email": false}, true
+    # meaning free to sign up with
+    username = request.args.get("username")
+    email = request.args.get("email")
+    if username is None and email is None:
+        return jsonify({"message": "username or email is required."}), 400
+
+    retry_after = available_ip_throttle.hit(request.remote_addr)
+    if retry_after:
+        return jsonify({"message": "Too many requests."}), 429, {"Retry-After": str(math.ceil(retry_after))}
+
+    username_taken, email_taken = availability.taken(username, email)
+    result = {}
+    if username is not None:
+        result["username"] = not username_taken
+    if email is not None:
+        result["email"] = not email_taken
+    return jsonify(result)
+
 @app.route("/auth/login",methods=["POST"])
+@skip_user_lookup
 def login():
     
     username = request.form["username"]
     rhythm_pattern_str = request.form.get("rhythmPattern")
 
+    retry_after = login_ip_throttle.hit(request.remote_addr) or login_user_throttle.check(username)
+    if retry_after:
+        res = make_response(render_template("auth/err.html", message="Too many login attempts, please wait and try again.", naviagte= "/login",naviagte_msg = "Retry"), 429)
+        res.headers["Retry-After"] = str(math.ceil(retry_after))
+        return res
+
     if not rhythm_pattern_str:
         return render_template("auth/err.html", message="Password is Missing", naviagte= url_for('login_page'),naviagte_msg = "Retry")
         
 
     try:
-        pattern = json.loads(rhythm_pattern_str)
-    except json.JSONDecodeError:
-        return render_template("auth/err.html", message="Internal Server Error Please Contact Admin", naviagte= "login",naviagte_msg = "Retry")
-        # return jsonify({"status": "error", "message": "Invalid rhythm pattern format."}), 400
-    
-    passString = ""
-    for note in pattern:
-        passString += note["note"]
-    
-    password = passString  
+        password = rhythm.parse(rhythm_pattern_str)
+    except rhythm.RhythmError as e:
+        return render_template("auth/err.html", message=str(e), naviagte= "/login",naviagte_msg = "Retry"), 400
     
     # Get user from database
     db_user = db.get_user_by_username(username) # Assuming a method to get user by username exists
     
     if db_user:
          
-        stored_hashed_password = db_user[3] # Hashed password is at index 3
-        
-        
-        if isinstance(stored_hashed_password, str):
-            stored_hashed_password = stored_hashed_password.encode("utf-8")
-
-        if bcrypt.checkpw(password.encode("utf-8"), stored_hashed_password):
-            token = jwt.encode({"id": db_user[0], "username": db_user[1]}, SECRET, algorithm="HS256")
+        # Hashed password is at index 3; older hashes were made from the
+        # note names rather than the compact encoding
+        check_password, stored_hashed_password, legacy = rhythm.credentials(password, db_user[3])
+
+        if hasher.check(check_password, stored_hashed_password):
+            # Upgrade legacy hashes and hashes made with an older, cheaper cost
+            if legacy or hasher.needs_rehash(stored_hashed_password):
+                try:
+                    new_hashed_password = rhythm.stored_hash(hasher.hash(password))
+                    if db.update_user_password(db_user[0], new_hashed_password):
+                        db_user = (*db_user[:3], new_hashed_password)
+                except HashingBusy:
+                    # Not worth failing the login over; retried next time
+                    pass
             res = make_response(render_template("auth/success.html", message="Login successful!"))
-            res.set_cookie("token", token)
+            issue_tokens(res, db_user[0], db_user[1], db_user[2], db.session_generation(db_user[0]))
             return res
         else:
+            login_user_throttle.hit(username)
             return render_template("auth/err.html", message="Invalid username or rhythm pattern.")
     else:
+        login_user_throttle.hit(username)
         return render_template("auth/err.html", message="Invalid username or rhythm pattern.", naviagte= "/login",naviagte_msg = "Retry")
 
 
+@app.route("/metrics")
+@skip_user_lookup
+def metrics_page():
+    return metrics.response()
+
+
 @app.route("/logout")
+@skip_user_lookup
 def logout():
     res = make_response(redirect(url_for('index')))
-    res.delete_cookie("token")
+    tokens.revoke(request.cookies.get(ACCESS_COOKIE))
+    tokens.revoke(request.cookies.get(REFRESH_COOKIE))
+    tokens.delete_cookies(res)
     return res
 
 @app.route("/edit-profile", methods=["GET", "POST"])
@@ -174,16 +314,19 @@ def edit_profile_page():
         new_username = request.form["username"]
         new_email = request.form["email"]
 
-        db.update_user_without_password(g.user[0], new_username, new_email)
+        updated = db.update_user_without_password(g.user[0], new_username, new_email)
+        if updated:
+            availability.add(new_username, new_email)
         
         response_message = "Profile updated successfully!"
         response_status = 200
 
-        # Update the token with new username if it changed
-        if new_username != g.user[1]:
-            updated_token = jwt.encode({"id": g.user[0], "username": new_username}, SECRET, algorithm="HS256")
+        # The tokens carry the username and email, so replace them if either changed
+        if updated and (new_username, new_email) != g.user[1:]:
+            tokens.revoke(request.cookies.get(ACCESS_COOKIE))
+            tokens.revoke(request.cookies.get(REFRESH_COOKIE))
             res = make_response(jsonify({"message": response_message}))
-            res.set_cookie("token", updated_token)
+            issue_tokens(res, g.user[0], new_username, new_email, g.claims["gen"])
             return res, response_status
 
         return jsonify({"message": response_message}), response_status
@@ -192,20 +335,20 @@ def edit_profile_page():
         "username": g.user[1],
         "email": g.user[2]
     }
-    return render_template("edit-profile.html", user=user)
+    response = make_response(render_template("edit-profile.html", user=user))
+    response.headers["Cache-Control"] = "no-store"
+    return response
 
 @app.route("/change-password", methods=["GET", "POST"])
 def change_password():
     if request.method == "GET":
-        return render_template("change-password.html")
+        return assets.page("change-password.html")
     elif request.method == "POST":
-        token = request.cookies.get('token')
-        if not token:
+        if not g.user:
             return jsonify({"message": "Unauthorized"}), 401
 
         try:
-            user_data = jwt.decode(token, SECRET, algorithms=["HS256"])
-            user_id = user_data.get('id')
+            user_id = g.user[0]
             
             data = request.get_json()
             old_rhythm_pattern = data.get('old_rhythm_pattern')
@@ -214,33 +357,32 @@ def change_password():
             if not old_rhythm_pattern or not new_rhythm_pattern:
                 return jsonify({"message": "Old and new rhythm patterns are required."}), 400
 
-            old_pass_string = "".join([note["note"] for note in old_rhythm_pattern])
-            new_pass_string = "".join([note["note"] for note in new_rhythm_pattern])
+            try:
+                old_password = rhythm.parse(old_rhythm_pattern)
+                new_password = rhythm.parse(new_rhythm_pattern)
+            except rhythm.RhythmError as e:
+                return jsonify({"message": str(e)}), 400
 
             user_details = db.get_user_by_id(user_id)
             if not user_details:
                 return jsonify({"message": "User not found."}), 404
 
-            stored_hashed_password = user_details[3]
-            if isinstance(stored_hashed_password, str):
-                stored_hashed_password = stored_hashed_password.encode("utf-8")
-
-            if not bcrypt.checkpw(old_pass_string.encode("utf-8"), stored_hashed_password):
+            check_password, stored_hashed_password, _ = rhythm.credentials(old_password, user_details[3])
+            if not hasher.check(check_password, stored_hashed_password):
                 return jsonify({"message": "Invalid old rhythm pattern."}), 400
 
-            bytes_new_password = new_pass_string.encode("utf-8")
-            salt = bcrypt.gensalt()
-            hashed_new_password = bcrypt.hashpw(bytes_new_password, salt)
+            hashed_new_password = rhythm.stored_hash(hasher.hash(new_password))
 
             db.update_user_password(user_id, hashed_new_password)
+            # Signs out every other session; this one moves to the new generation
+            new_generation = db.bump_session_generation(user_id)
+            tokens.revoke_generation(user_id, new_generation - 1)
             res = make_response(jsonify({"message": "Password changed successfully!"}))
-            res.delete_cookie("token")
+            issue_tokens(res, user_id, user_details[1], user_details[2], new_generation)
             return res
 
-        except jwt.ExpiredSignatureError:
-            return jsonify({"message": "Token expired. Please log in again."}), 401
-        except jwt.InvalidTokenError:
-            return jsonify({"message": "Invalid token. Please log in again."}), 401
+        except HashingBusy:
+            return jsonify({"message": "Server is busy, please try again in a moment."}), 503, {"Retry-After": "1"}
         except Exception as e:
             print(f"Error changing password: {e}")
             return jsonify({"message": "An internal error occurred."}), 500
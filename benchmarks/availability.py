@@ -0,0 +1,69 @@
+"""Memory and lookup cost of the username/email availability index.
+
+Fills a scratch database with --users users, builds the Bloom filter over
+it, and compares lookups through the index with the exact database check
+it replaces for names that are free.
+
+    python -m benchmarks.availability --users 1000000 --lookups 100000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from core.availability import AvailabilityIndex
+from core.db import Database
+from core.hashing import Hasher
+
+HASH = b"r1$2b$12$" + b"x" * 53
+
+
+def timed(fn, keys):
+    start = time.perf_counter()
+    for key in keys:
+        fn(key)
+    return (time.perf_counter() - start) / len(keys) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000000)
+    parser.add_argument("--lookups", type=int, default=100000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, "bench.db"))
+        for start in range(0, args.users, 50000):
+            rows = [(f"user{i}", f"user{i}@example.com", HASH) for i in range(start, min(start + 50000, args.users))]
+            db.add_users_bulk(rows)
+
+        index = AvailabilityIndex(db, lazy=True)
+        start = time.perf_counter()
+        index.build()
+        build = time.perf_counter() - start
+        bloom = index.filter
+        print(f"users           {args.users:,}")
+        print(f"build           {build:.1f}s")
+        print(f"filter          {len(bloom.bits) / 2**20:.1f} MiB, {bloom.hashes} hashes, {bloom.size / bloom.count:.1f} bits/key")
+
+        taken = [f"user{i * 7919 % args.users}" for i in range(args.lookups)]
+        free = [f"free{i}" for i in range(args.lookups)]
+        false_positives = sum("u:" + name in bloom for name in free)
+        print(f"false positives {false_positives / len(free):.2%}")
+
+        print(f"{'lookup':<16}{'index us':>10}{'database us':>13}")
+        for label, names in (("free username", free), ("taken username", taken)):
+            via_index = timed(lambda name: index.taken(username=name), names)
+            via_db = timed(lambda name: db.taken(name, None), names)
+            print(f"{label:<16}{via_index:>10.1f}{via_db:>13.1f}")
+
+        # What a duplicate signup used to spend before add_user rejected it
+        hasher = Hasher(workers=0)
+        start = time.perf_counter()
+        hasher.hash(b"duplicate")
+        print(f"bcrypt hash     {(time.perf_counter() - start) * 1e6:>10.0f} us at cost {hasher.rounds}")
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
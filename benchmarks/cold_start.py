@@ -0,0 +1,90 @@
+"""Measure cold start: importing the app and its first requests.
+
+Each run is a fresh process set up like a Vercel function (the bundled
+database.db as a read-only snapshot, a writable path that does not exist
+yet), with FAST_START=0 and FAST_START=1. Reported are the medians of
+interpreter start to `import app` done, the first page request, and the
+first signup and login, the requests that pay for bcrypt.
+
+    python -m benchmarks.cold_start --repeat 10
+    python -m benchmarks.cold_start --repeat 10 --output cold-start.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+PHASES = ("import", "first_page", "first_signup", "first_login")
+
+
+def child(started):
+    # Runs inside the measured process; `started` is when the parent
+    # launched it, so interpreter startup is part of the import time
+    timings = {}
+    import app as snapbeat
+    timings["import"] = time.time() - started
+
+    client = snapbeat.app.test_client()
+    pattern = json.dumps([{"note": "C4"}, {"note": "D4"}, {"note": "E4"}])
+    requests = {
+        "first_page": lambda: client.get("/login"),
+        "first_signup": lambda: client.post("/auth/signup", data={"username": "cold", "email": "cold@example.com", "rhythmPattern": pattern}),
+        "first_login": lambda: client.post("/auth/login", data={"username": "cold", "rhythmPattern": pattern}),
+    }
+    for phase, send in requests.items():
+        start = time.perf_counter()
+        send()
+        timings[phase] = time.perf_counter() - start
+    print(json.dumps(timings))
+
+
+def run(fast_start, tmp):
+    env = {
+        **os.environ,
+        "FAST_START": fast_start,
+        "DATABASE_PATH": os.path.join(tmp, f"cold-{fast_start}-{time.time_ns()}.db"),
+        "DATABASE_SNAPSHOT": "database.db",
+    }
+    out = subprocess.run(
+        [sys.executable, "-m", "benchmarks.cold_start", "--child", str(time.time())],
+        env=env, check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--output", help="also write the results here as JSON")
+    parser.add_argument("--child", type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        child(args.child)
+        return
+
+    samples = {"0": {phase: [] for phase in PHASES}, "1": {phase: [] for phase in PHASES}}
+    with tempfile.TemporaryDirectory() as tmp:
+        for _ in range(args.repeat):
+            for fast_start in ("0", "1"):
+                for phase, seconds in run(fast_start, tmp).items():
+                    samples[fast_start][phase].append(seconds)
+
+    results = {
+        f"fast_start={fast_start}": {phase: round(statistics.median(values) * 1000, 2) for phase, values in phases.items()}
+        for fast_start, phases in samples.items()
+    }
+    print(f"{'phase':<14}{'default ms':>12}{'fast ms':>12}")
+    for phase in PHASES:
+        print(f"{phase:<14}{results['fast_start=0'][phase]:>12.1f}{results['fast_start=1'][phase]:>12.1f}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"repeat": args.repeat, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Compare user lookups per second with and without the pooled connection layer.
+
+    python -m benchmarks.db_lookup --users 1000 --lookups 20000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from core.db import Database
+
+
+class LegacyDatabase(Database):
+    # The connection strategy used before connections were pooled: a new
+    # connection per call, with the schema DDL run and committed every time
+    def get_db_connection(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        cur = conn.cursor()
+        cur.execute(self.user_table_create_query)
+        conn.commit()
+        return conn
+
+
+def seed(db, users):
+    con = db.get_db_connection()
+    with con:
+        con.executemany(
+            "INSERT INTO users(username, email, password) VALUES(?,?,?)",
+            ((f"user{i}", f"user{i}@example.com", b"x" * 60) for i in range(users)),
+        )
+
+
+def run(db, ids):
+    start = time.perf_counter()
+    for user_id in ids:
+        db.get_user_by_id(user_id)
+    return len(ids) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--lookups", type=int, default=20000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        pooled = Database(db_path=path)
+        seed(pooled, args.users)
+        legacy = LegacyDatabase(db_path=path)
+
+        ids = [random.randint(1, args.users) for _ in range(args.lookups)]
+        before = run(legacy, ids)
+        after = run(pooled, ids)
+        pooled.close()
+
+    print(f"legacy : {before:12,.0f} lookups/s")
+    print(f"pooled : {after:12,.0f} lookups/s")
+    print(f"speedup: {after / before:12.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Measure the per-request cost of the metrics instrumentation.
+
+Times sequential requests through the Flask test client in fresh
+processes with METRICS=0 and METRICS=1, alternating runs and keeping the
+fastest of each, and reports the relative overhead per route.
+
+    python -m benchmarks.metrics_overhead --requests 3000 --repeat 5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROUTES = {"index": "/", "login_page": "/login", "account": "/account"}
+
+
+def child(requests):
+    # Runs inside the measured process, after METRICS has been set
+    import app as snapbeat
+
+    client = snapbeat.app.test_client()
+    pattern = json.dumps([{"note": "C4"}, {"note": "D4"}, {"note": "E4"}])
+    client.post("/auth/signup", data={"username": "bench", "email": "bench@example.com", "rhythmPattern": pattern})
+
+    results = {}
+    for route, path in ROUTES.items():
+        for _ in range(200):
+            client.get(path)
+        start = time.perf_counter()
+        for _ in range(requests):
+            client.get(path)
+        results[route] = (time.perf_counter() - start) / requests * 1e6
+    print(json.dumps(results))
+
+
+def run(metrics, requests, tmp):
+    env = {
+        **os.environ,
+        "METRICS": metrics,
+        "DATABASE_PATH": os.path.join(tmp, f"bench-{metrics}-{time.time_ns()}.db"),
+        "BCRYPT_ROUNDS": "4",
+        "BCRYPT_WORKERS": "0",
+    }
+    out = subprocess.run(
+        [sys.executable, "-m", "benchmarks.metrics_overhead", "--child", "--requests", str(requests)],
+        env=env, check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=3000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.requests)
+        return
+
+    best = {"0": {}, "1": {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        for _ in range(args.repeat):
+            for metrics in ("0", "1"):
+                for route, us in run(metrics, args.requests, tmp).items():
+                    best[metrics][route] = min(best[metrics].get(route, us), us)
+
+    print(f"{'route':<12}{'off us/req':>12}{'on us/req':>12}{'overhead':>10}")
+    for route in ROUTES:
+        off, on = best["0"][route], best["1"][route]
+        print(f"{route:<12}{off:>12.1f}{on:>12.1f}{on / off - 1:>10.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""Compare rhythm pattern parsing against the string concatenation it replaced.
+
+    python -m benchmarks.rhythm_parse
+"""
+import json
+import random
+import timeit
+
+from core import rhythm
+
+
+def legacy_parse(raw):
+    # What signup/login did before core.rhythm existed
+    pattern = json.loads(raw)
+    passString = ""
+    for note in pattern:
+        passString += note["note"]
+    return passString.encode("utf-8")
+
+
+def make_pattern(beats):
+    keys = list(rhythm.KEY_NOTES)
+    return json.dumps([
+        {"key": key, "note": rhythm.KEY_NOTES[key], "time": random.randint(0, 900)}
+        for key in random.choices(keys, k=beats)
+    ])
+
+
+def bench(fn, raw, number):
+    per_call = min(timeit.repeat(lambda: fn(raw), number=number, repeat=5)) / number
+    return per_call * 1e6
+
+
+def main():
+    cases = [
+        ("8 beats", make_pattern(8), 20000),
+        ("72 beats", make_pattern(72), 5000),
+        ("100k beats (hostile)", make_pattern(100000), 5),
+    ]
+    print(f"{'payload':<22}{'bytes':>10}{'legacy us':>14}{'rhythm us':>14}")
+    for name, raw, number in cases:
+        before = bench(legacy_parse, raw, number)
+
+        def guarded(raw):
+            try:
+                return rhythm.parse(raw)
+            except rhythm.RhythmError:
+                return None
+
+        after = bench(guarded, raw, number)
+        print(f"{name:<22}{len(raw):>10}{before:>14.2f}{after:>14.2f}")
+
+
+if __name__ == "__main__":
+    main()
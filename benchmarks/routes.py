@@ -0,0 +1,320 @@
+"""Throughput and latency benchmark for every snapBeat-auth route.
+
+Seeds a fresh database with N users, drives each route at a given
+concurrency either in-process through the Flask test client or over HTTP
+against a locally spawned gunicorn, and writes per-route throughput and
+p50/p95/p99 latency as JSON. Nothing leaves the machine.
+
+    python -m benchmarks.routes run --driver client --users 1000 --output current.json
+    python -m benchmarks.routes run --driver gunicorn --workers 4 --concurrency 16
+    python -m benchmarks.routes compare baseline.json current.json --threshold 0.10
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PATTERN = [{"key": "Q", "note": "C4", "time": 0}, {"key": "E", "note": "D4", "time": 300}, {"key": "T", "note": "E4", "time": 300}]
+ROUTES = ["index", "signup", "login", "account", "edit_profile", "change_password"]
+
+
+class ClientDriver:
+    # In-process requests through the Flask test client. The app is
+    # imported only after the environment has been prepared.
+    def __init__(self, env):
+        os.environ.update(env)
+        sys.path.insert(0, ROOT)
+        import app as snapbeat
+        self.app = snapbeat.app
+        self._local = threading.local()
+
+    def request(self, method, path, form=None, body=None, cookie=None):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.app.test_client(use_cookies=False)
+        headers = {"Cookie": cookie} if cookie else {}
+        response = client.open(path, method=method, data=form, json=body, headers=headers)
+        return response.status_code, response.headers.getlist("Set-Cookie")
+
+    def close(self):
+        pass
+
+
+class GunicornDriver:
+    # Real HTTP against gunicorn listening on a free local port
+    def __init__(self, env, workers):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            self.port = s.getsockname()[1]
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "app:app", "-b", f"127.0.0.1:{self.port}", "-w", str(workers), "--log-level", "warning"],
+            cwd=ROOT,
+            env={**os.environ, **env},
+        )
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=0.2).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        self.close()
+        raise RuntimeError("gunicorn did not start")
+
+    def request(self, method, path, form=None, body=None, cookie=None):
+        headers = {"Cookie": cookie} if cookie else {}
+        payload = None
+        if form is not None:
+            payload = urllib.parse.urlencode(form)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        elif body is not None:
+            payload = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+        try:
+            conn.request(method, path, body=payload, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            return response.status, response.headers.get_all("Set-Cookie") or []
+        finally:
+            conn.close()
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+def seed(db_path, users, rounds):
+    # Seeds in a child process so the parent never imports the app before
+    # the driver has set up its environment
+    script = (
+        "import sys, bcrypt\n"
+        "from core import rhythm\n"
+        "from core.db import Database\n"
+        "db = Database(sys.argv[1])\n"
+        f"hashed = rhythm.stored_hash(bcrypt.hashpw(rhythm.parse({PATTERN!r}), bcrypt.gensalt({rounds})))\n"
+        "n = int(sys.argv[2])\n"
+        "db.add_users_bulk([(f'user{i}', f'user{i}@example.com', hashed) for i in range(n)])\n"
+    )
+    subprocess.run([sys.executable, "-c", script, db_path, str(users)], cwd=ROOT, check=True)
+
+
+def cookie_header(set_cookies):
+    cookies = [header.split(";", 1)[0] for header in set_cookies]
+    return "; ".join(cookie for cookie in cookies if not cookie.endswith("="))
+
+
+class Scenario:
+    def __init__(self, driver, users, sessions):
+        self.driver = driver
+        self.users = users
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        # Routes behind a login cycle through a fixed set of logged-in
+        # users, so session setup is not part of what they measure
+        self.sessions = {}
+        for i in range(min(users, sessions)):
+            status, set_cookies = self.driver.request("POST", "/auth/login", form={"username": f"user{i}", "rhythmPattern": json.dumps(PATTERN)})
+            cookie = cookie_header(set_cookies)
+            if status != 200 or not cookie:
+                raise RuntimeError(f"could not log in as user{i} (HTTP {status})")
+            self.sessions[i] = cookie
+
+    def session(self, i):
+        with self.lock:
+            return self.sessions[i]
+
+    def update_session(self, i, set_cookies):
+        cookie = cookie_header(set_cookies)
+        if cookie:
+            with self.lock:
+                self.sessions[i] = cookie
+
+    def __call__(self, route):
+        n = next(self.counter)
+        i = n % (self.users if route == "login" else len(self.sessions))
+        if route == "index":
+            return self.driver.request("GET", "/")[0] == 200
+        if route == "signup":
+            form = {"username": f"new{n}-{time.time_ns()}", "email": f"new{n}-{time.time_ns()}@example.com", "rhythmPattern": json.dumps(PATTERN)}
+            return self.driver.request("POST", "/auth/signup", form=form)[0] == 200
+        if route == "login":
+            form = {"username": f"user{i}", "rhythmPattern": json.dumps(PATTERN)}
+            return self.driver.request("POST", "/auth/login", form=form)[0] == 200
+        if route == "account":
+            return self.driver.request("GET", "/account", cookie=self.session(i))[0] == 200
+        if route == "edit_profile":
+            form = {"username": f"user{i}", "email": f"user{i}+{n}@example.com"}
+            status, set_cookies = self.driver.request("POST", "/edit-profile", form=form, cookie=self.session(i))
+            self.update_session(i, set_cookies)
+            return status == 200
+        if route == "change_password":
+            body = {"old_rhythm_pattern": PATTERN, "new_rhythm_pattern": PATTERN}
+            status, set_cookies = self.driver.request("POST", "/change-password", body=body, cookie=self.session(i))
+            self.update_session(i, set_cookies)
+            return status == 200
+        raise ValueError(route)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure(scenario, route, requests, concurrency):
+    latencies = []
+    errors = 0
+    remaining = itertools.count()
+    lock = threading.Lock()
+
+    def worker():
+        nonlocal errors
+        while next(remaining) < requests:
+            start = time.perf_counter()
+            try:
+                ok = scenario(route)
+            except Exception:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                errors += not ok
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / wall,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def run(args):
+    tmp = tempfile.mkdtemp(prefix="snapbeat-bench-")
+    db_path = os.path.join(tmp, "bench.db")
+    seed(db_path, args.users, args.rounds)
+    env = {
+        "DATABASE_PATH": db_path,
+        "BCRYPT_ROUNDS": str(args.rounds),
+        "BCRYPT_QUEUE_SIZE": str(max(64, args.concurrency * 4)),
+        # The benchmark logs in far faster than any real user would
+        "LOGIN_IP_PER_MINUTE": "0",
+        "LOGIN_USER_PER_MINUTE": "0",
+        "THROTTLE_PATH": os.path.join(tmp, "throttle.db"),
+    }
+
+    if args.driver == "gunicorn":
+        driver = GunicornDriver(env, args.workers)
+    else:
+        driver = ClientDriver(env)
+
+    results = {}
+    try:
+        scenario = Scenario(driver, args.users, args.sessions)
+        for route in args.routes:
+            # Warm up connections, caches and sessions before measuring
+            measure(scenario, route, min(args.requests, args.concurrency * 2), args.concurrency)
+            results[route] = measure(scenario, route, args.requests, args.concurrency)
+            r = results[route]
+            print(
+                f"{route:<16}{r['throughput']:>10.1f} req/s  p50 {r['p50_ms']:8.2f} ms  "
+                f"p95 {r['p95_ms']:8.2f} ms  p99 {r['p99_ms']:8.2f} ms  errors {r['errors']}"
+            )
+    finally:
+        driver.close()
+
+    report = {
+        "meta": {
+            "driver": args.driver,
+            "workers": args.workers if args.driver == "gunicorn" else None,
+            "users": args.users,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "bcrypt_rounds": args.rounds,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "routes": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"wrote {args.output}")
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)["routes"]
+    with open(args.current) as f:
+        current = json.load(f)["routes"]
+
+    regressions = 0
+    for route, now in current.items():
+        before = baseline.get(route)
+        if before is None:
+            print(f"{route:<16}(no baseline)")
+            continue
+        throughput_change = now["throughput"] / before["throughput"] - 1 if before["throughput"] else 0.0
+        p95_change = now["p95_ms"] / before["p95_ms"] - 1 if before["p95_ms"] else 0.0
+        regressed = throughput_change < -args.threshold or p95_change > args.threshold or now["errors"] > before["errors"]
+        regressions += regressed
+        print(
+            f"{route:<16}throughput {throughput_change:+7.1%}  p95 {p95_change:+7.1%}  "
+            f"errors {before['errors']}->{now['errors']}  {'REGRESSION' if regressed else 'ok'}"
+        )
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="benchmark the routes")
+    run_parser.add_argument("--driver", choices=["client", "gunicorn"], default="client")
+    run_parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="gunicorn workers")
+    run_parser.add_argument("--users", type=int, default=1000, help="seeded users")
+    run_parser.add_argument("--sessions", type=int, default=16, help="logged-in users for account/edit/password routes")
+    run_parser.add_argument("--requests", type=int, default=200, help="requests per route")
+    run_parser.add_argument("--concurrency", type=int, default=4)
+    run_parser.add_argument("--rounds", type=int, default=8, help="bcrypt cost for seeded and new users")
+    run_parser.add_argument("--routes", nargs="+", choices=ROUTES, default=ROUTES)
+    run_parser.add_argument("--output", help="write results as JSON")
+
+    compare_parser = commands.add_parser("compare", help="flag regressions against a baseline")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.10, help="allowed relative slowdown")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        sys.exit(compare(args))
+
+
+if __name__ == "__main__":
+    main()
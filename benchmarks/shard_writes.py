@@ -0,0 +1,74 @@
+"""Signup write throughput of the single-file and sharded storage backends.
+
+Several processes (standing in for gunicorn workers), each with a few
+threads, insert distinct users through add_user and then update each
+one's password; reported is writes per second for each backend.
+
+    python -m benchmarks.shard_writes --processes 4 --threads 4 --users 2000 --shards 1 2 4 8
+"""
+import argparse
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+
+from core.db import Database
+from core.db.sharded import ShardedDatabase
+
+HASH = b"r1$2b$12$" + b"x" * 53
+
+
+def open_backend(kind, path, shards):
+    if kind == "single":
+        return Database(os.path.join(path, "database.db"))
+    return ShardedDatabase(path, shards)
+
+
+def worker(args):
+    kind, path, shards, process, threads, users = args
+    db = open_backend(kind, path, shards)
+
+    def insert(thread):
+        for i in range(users):
+            name = f"p{process}-t{thread}-u{i}"
+            user = db.add_user(name, name + "@example.com", HASH)
+            db.update_user_password(user[0], HASH)
+
+    pool = [threading.Thread(target=insert, args=(t,)) for t in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    db.close()
+
+
+def run(kind, shards, processes, threads, users):
+    with tempfile.TemporaryDirectory() as path:
+        # Create the files up front so setup is not part of the timing
+        open_backend(kind, path, shards).close()
+        jobs = [(kind, path, shards, p, threads, users) for p in range(processes)]
+        with multiprocessing.Pool(processes) as pool:
+            start = time.perf_counter()
+            pool.map(worker, jobs)
+            elapsed = time.perf_counter() - start
+    return processes * threads * users * 2 / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--users", type=int, default=2000, help="users inserted per thread")
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    baseline = run("single", None, args.processes, args.threads, args.users)
+    print(f"{'single file':<14}{baseline:>12,.0f} writes/s")
+    for shards in args.shards:
+        rate = run("sharded", shards, args.processes, args.threads, args.users)
+        print(f"{f'{shards} shards':<14}{rate:>12,.0f} writes/s  ({rate / baseline:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
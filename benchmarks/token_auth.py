@@ -0,0 +1,88 @@
+"""Per-request cost of authenticating a session cookie, before and after tokens.
+
+Before: every request ran a full jwt.decode of a token without expiry and
+loaded the user row (from a user cache when warm, else from SQLite).
+After: access tokens are verified once and then recognised by digest, and
+carry the claims pages need, so there is no user lookup. Also times GET
+/account end to end through the Flask test client.
+
+    python -m benchmarks.token_auth --users 1000 --requests 20000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+SECRET = "benchmark-secret-benchmark-secret"
+
+
+def per_call(fn, items):
+    start = time.perf_counter()
+    for item in items:
+        fn(item)
+    return (time.perf_counter() - start) / len(items) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=20000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ.update({
+            "DATABASE_PATH": os.path.join(tmp, "bench.db"),
+            "SECRET": SECRET,
+            "BCRYPT_ROUNDS": "4",
+            "BCRYPT_WORKERS": "0",
+        })
+        import jwt
+
+        import app as snapbeat
+        from core.cache import UserCache
+        from core.tokens import TokenService
+
+        db = snapbeat.db
+        db.add_users_bulk([(f"user{i}", f"user{i}@example.com", b"r1$2b$04$" + b"x" * 53) for i in range(args.users)])
+        users = list(db.iter_users())
+        # One token per user, each presented requests / users times
+        tokens = TokenService(SECRET, db)
+        issued = [tokens.issue(user[0], user[1], user[2], 0)[0] for user in users]
+        legacy = [jwt.encode({"id": user[0], "username": user[1]}, SECRET, algorithm="HS256") for user in users]
+        access_tokens = [issued[i % len(users)] for i in range(args.requests)]
+        legacy_tokens = [legacy[i % len(users)] for i in range(args.requests)]
+
+        # The user row cache the app kept in front of get_user_by_id
+        user_cache = UserCache()
+
+        def before(token, use_cache=True):
+            claims = jwt.decode(token.encode("utf-8"), SECRET, algorithms=["HS256"])
+            user = user_cache.get(claims["id"]) if use_cache else None
+            if user is None:
+                user = db.get_user_by_id(claims["id"])
+                user_cache.put(claims["id"], user)
+            return user
+
+        results = [
+            ("before, cold user cache", per_call(lambda token: before(token, use_cache=False), legacy_tokens)),
+            ("before, warm user cache", per_call(before, legacy_tokens)),
+        ]
+        tokens.verified.clear()
+        results.append(("after, first sight", per_call(tokens.verify_access, issued)))
+        results.append(("after, cached", per_call(tokens.verify_access, access_tokens)))
+
+        print(f"{'auth per request':<26}{'us':>8}")
+        for label, us in results:
+            print(f"{label:<26}{us:>8.1f}")
+
+        client = snapbeat.app.test_client(use_cookies=False)
+        snapbeat.tokens.verified.clear()
+        cookies = [{"Cookie": f"token={token}"} for token in access_tokens]
+        for headers in cookies[:len(users)]:
+            client.get("/account", headers=headers)
+        us = per_call(lambda headers: client.get("/account", headers=headers), cookies)
+        print(f"{'GET /account end to end':<26}{us:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
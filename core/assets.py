@@ -0,0 +1,130 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+
+from flask import make_response, render_template, request
+
+try:
+    import brotli
+except ImportError:  # optional; gzip is always available
+    brotli = None
+
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+# Fingerprinted static urls never change content, so they can be cached forever
+IMMUTABLE = "public, max-age=31536000, immutable"
+# Everything else is cached but revalidated with its ETag on every use
+REVALIDATE = "no-cache"
+
+
+class CachedBody:
+    def __init__(self, data, mimetype):
+        self.mimetype = mimetype
+        self.digest = hashlib.sha256(data).hexdigest()[:20]
+        self.variants = {"identity": data}
+        if mimetype.startswith(COMPRESSIBLE_TYPES) and len(data) > 256:
+            compressed = gzip.compress(data, compresslevel=9, mtime=0)
+            if len(compressed) < len(data):
+                self.variants["gzip"] = compressed
+            if brotli is not None:
+                compressed = brotli.compress(data, quality=11)
+                if len(compressed) < len(data):
+                    self.variants["br"] = compressed
+
+    def pick_encoding(self):
+        # Smallest variant the client accepts
+        accepted = [encoding for encoding in ("br", "gzip") if encoding in self.variants and request.accept_encodings[encoding]]
+        return min(accepted, key=lambda encoding: len(self.variants[encoding])) if accepted else "identity"
+
+    def respond(self, cache_control):
+        encoding = self.pick_encoding()
+        etag = self.digest if encoding == "identity" else f"{self.digest}-{encoding}"
+
+        if request.if_none_match.contains(etag):
+            res = make_response("", 304)
+        else:
+            res = make_response(self.variants[encoding])
+            res.mimetype = self.mimetype
+            if encoding != "identity":
+                res.headers["Content-Encoding"] = encoding
+        res.set_etag(etag)
+        res.headers["Cache-Control"] = cache_control
+        if len(self.variants) > 1:
+            res.vary.add("Accept-Encoding")
+        return res
+
+
+class AssetCache:
+    # Serves constant pages pre-rendered at startup and the static folder
+    # from memory, with strong ETags, 304s and pre-compressed variants.
+    # url_for('static', ...) gains a ?v=<content hash> so those urls can be
+    # cached as immutable.
+    #
+    # With lazy=True nothing is read or rendered until it is first asked
+    # for, which keeps it off the cold start of a serverless function.
+    def __init__(self, app, lazy=False):
+        self.app = app
+        self.lazy = lazy
+        self.pages = {}
+        self.static = None
+        self._lock = threading.Lock()
+        if not lazy:
+            self._ensure_static()
+        app.url_defaults(self._fingerprint_static)
+        app.view_functions["static"] = self.send_static
+
+    def _ensure_static(self):
+        if self.static is None:
+            with self._lock:
+                if self.static is None:
+                    self.static = self._load_static()
+        return self.static
+
+    def _load_static(self):
+        static = {}
+        folder = self.app.static_folder
+        if not folder or not os.path.isdir(folder):
+            return static
+        for root, _, files in os.walk(folder):
+            for name in files:
+                path = os.path.join(root, name)
+                filename = os.path.relpath(path, folder).replace(os.sep, "/")
+                mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+                with open(path, "rb") as f:
+                    static[filename] = CachedBody(f.read(), mimetype)
+        return static
+
+    def _fingerprint_static(self, endpoint, values):
+        if endpoint == "static" and "filename" in values:
+            body = self._ensure_static().get(values["filename"])
+            if body is not None:
+                values.setdefault("v", body.digest)
+
+    def prerender(self, *templates):
+        # Lazily, each page is rendered by the first request for it instead
+        if not self.lazy:
+            for template in templates:
+                self._render(template)
+
+    def _render(self, template):
+        # Always in a request context of its own, so a page rendered during
+        # a request cannot pick up anything specific to that request
+        with self.app.test_request_context("/"):
+            html = render_template(template).encode("utf-8")
+        body = self.pages[template] = CachedBody(html, "text/html")
+        return body
+
+    def page(self, template):
+        body = self.pages.get(template)
+        if body is None:
+            body = self._render(template)
+        return body.respond(REVALIDATE)
+
+    def send_static(self, filename):
+        body = self._ensure_static().get(filename)
+        if body is None:
+            # Added after startup; let Flask serve it from disk
+            return self.app.send_static_file(filename)
+        versioned = request.args.get("v") == body.digest
+        return body.respond(IMMUTABLE if versioned else REVALIDATE)
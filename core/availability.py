@@ -0,0 +1,150 @@
+import hashlib
+import math
+import os
+import threading
+import time
+
+
+class BloomFilter:
+    # Set membership in about 10 bits per item at a 1% false positive rate;
+    # "no" answers are always right, "yes" answers need confirming
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.size = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # Double hashing: k positions out of one 128-bit digest
+        digest = int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest(), "little")
+        h1, h2 = digest & 0xFFFFFFFFFFFFFFFF, (digest >> 64) | 1
+        size = self.size
+        return [(h1 + i * h2) % size for i in range(self.hashes)]
+
+    def add(self, key):
+        bits = self.bits
+        for position in self._positions(key):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for position in self._positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class AvailabilityIndex:
+    # Answers "is this username / email taken?" without hashing or, for
+    # names that are free, without touching the database: a Bloom filter
+    # over every username and email, with possible hits confirmed by an
+    # exact lookup.
+    #
+    # The filter is built in a background thread (with lazy=True, starting
+    # on first use); until it is ready every check is an exact lookup.
+    #
+    # Each process keeps its own filter. It follows the database's name
+    # change log at most every `refresh_interval` seconds, so signups and
+    # renames in other gunicorn workers show up shortly; a name freed by a
+    # rename stays in the filter and costs one exact lookup. A stale
+    # "available" is harmless because add_user still enforces uniqueness.
+    log_batch = 5000
+
+    def __init__(self, db, error_rate=0.01, refresh_interval=1.0, lazy=False):
+        self.db = db
+        self.error_rate = error_rate
+        self.refresh_interval = refresh_interval
+        self.filter = None
+        self._last_seq = 0
+        self._last_refresh = 0.0
+        self._lock = threading.Lock()
+        self._builder = None
+        self._builder_pid = None
+        if not lazy:
+            self._start_build()
+
+    def _start_build(self):
+        with self._lock:
+            # Also restarts a build cut off by a fork
+            if self._builder is not None and self._builder_pid == os.getpid() and self._builder.is_alive():
+                return
+            self._builder = threading.Thread(target=self.build, name="availability-index", daemon=True)
+            self._builder_pid = os.getpid()
+            self._builder.start()
+
+    def build(self):
+        # Anything written after this point in the log is picked up by the
+        # next refresh, even if the scan below has already seen it
+        last_seq = self.db.last_name_change()
+        # Two keys per user, and room for twice as many before the filter is
+        # rebuilt
+        keys = 2 * self.db.count_users()
+        bloom = BloomFilter(max(2 * keys, 100000), self.error_rate)
+        for _, username, email, _ in self.db.iter_users(5000):
+            bloom.add("u:" + username)
+            bloom.add("e:" + email)
+        with self._lock:
+            self.filter = bloom
+            self._last_seq = last_seq
+            self._last_refresh = 0.0
+
+    def _refresh(self, bloom):
+        # Claims the refresh under the lock, then reads the log without it so
+        # add() and other requests are not held up by the query
+        with self._lock:
+            now = time.monotonic()
+            if self.filter is not bloom or now - self._last_refresh < self.refresh_interval:
+                return
+            self._last_refresh = now
+            after_seq = self._last_seq
+        changes = self.db.name_changes(after_seq, self.log_batch)
+        if changes is None:
+            # Too far behind the log; start over from the users table
+            self._start_build()
+            return
+        if not changes:
+            return
+        with self._lock:
+            if self.filter is not bloom or self._last_seq != after_seq:
+                return
+            for _, username, email in changes:
+                bloom.add("u:" + username)
+                bloom.add("e:" + email)
+            self._last_seq = changes[-1][0]
+            if len(changes) == self.log_batch:
+                # More to come; catch up on the next call
+                self._last_refresh = 0.0
+
+    def _ready(self):
+        # The current filter, or None while the first one is being built
+        bloom = self.filter
+        if bloom is None or bloom.count > bloom.capacity:
+            # An overfull filter gives more false positives but never false
+            # negatives, so it is used until its replacement is ready
+            self._start_build()
+        if bloom is not None and time.monotonic() - self._last_refresh >= self.refresh_interval:
+            self._refresh(bloom)
+        return bloom
+    def add(self, username, email):
+        # Call after a user is created or renamed
+        bloom = self._ready()
+        if bloom is None:
+            return
+        with self._lock:
+            bloom.add("u:" + username)
+            bloom.add("e:" + email)
+
+    def taken(self, username=None, email=None):
+        # (username is taken, email is taken); None for a value not given
+        bloom = self._ready()
+        if bloom is None:
+            return self.db.taken(username, email)
+        username_taken = None if username is None else "u:" + username in bloom
+        email_taken = None if email is None else "e:" + email in bloom
+        if username_taken or email_taken:
+            exact = self.db.taken(username if username_taken else None, email if email_taken else None)
+            username_taken = exact[0] if username_taken else username_taken
+            email_taken = exact[1] if email_taken else email_taken
+        return username_taken, email_taken
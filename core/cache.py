@@ -0,0 +1,98 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+def _row_size(row):
+    return sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+
+
+class UserCache:
+    # Bounded LRU of rows keyed by id, such as TokenService's verified
+    # token claims. Entries expire after `ttl` seconds so changes made by
+    # other worker processes are picked up.
+    #
+    # A row read from the database can be outdated by a write that commits
+    # (and invalidates) before the reader gets to put() it. Readers take
+    # version(user_id) before reading and pass it to put(), which drops the
+    # row if the id has been invalidated since.
+    def __init__(self, max_entries=10000, max_bytes=8 * 1024 * 1024, ttl=30.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Invalidation counts of recently invalidated ids; reset (with a new
+        # epoch, so every version taken before is stale) when it grows too big
+        self._invalidations = {}
+        self._epoch = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            row, expires, size = entry
+            if expires < time.monotonic():
+                del self._entries[user_id]
+                self.size_bytes -= size
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return row
+
+    def version(self, user_id):
+        return (self._epoch, self._invalidations.get(user_id, 0))
+
+    def put(self, user_id, row, version=None):
+        if row is None:
+            return
+        size = _row_size(row)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if version is not None and version != (self._epoch, self._invalidations.get(user_id, 0)):
+                return
+            old = self._entries.pop(user_id, None)
+            if old is not None:
+                self.size_bytes -= old[2]
+            self._entries[user_id] = (row, time.monotonic() + self.ttl, size)
+            self.size_bytes += size
+            while len(self._entries) > self.max_entries or self.size_bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.size_bytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, user_id):
+        with self._lock:
+            if len(self._invalidations) >= self.max_entries:
+                self._invalidations.clear()
+                self._epoch += 1
+            self._invalidations[user_id] = self._invalidations.get(user_id, 0) + 1
+            entry = self._entries.pop(user_id, None)
+            if entry is not None:
+                self.size_bytes -= entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
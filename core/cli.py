@@ -0,0 +1,205 @@
+import csv
+import json
+import os
+import time
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from core import rhythm
+from core.hashing import hash_rounds
+from core.db import Database
+from core.db.sharded import ShardedDatabase
+
+users_cli = AppGroup("users", help="Bulk import and export of user accounts.")
+
+
+def _detect_format(file, fmt):
+    if fmt:
+        return fmt
+    name = getattr(file, "name", "")
+    return "csv" if name.endswith(".csv") else "ndjson"
+
+
+def _read_records(file, fmt):
+    # Records as dicts; a line that is not a JSON object comes out as None,
+    # so the import can count it as invalid and carry on
+    if fmt == "csv":
+        yield from csv.DictReader(file)
+    else:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield record if isinstance(record, dict) else None
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _valid_hash(password):
+    # A bcrypt hash ($2b$12$ + 53 characters of salt and digest), with or
+    # without the rhythm.HASH_PREFIX of the current encoding
+    if password.startswith(rhythm.HASH_PREFIX):
+        password = password[len(rhythm.HASH_PREFIX):]
+    return len(password) == 60 and password.startswith((b"$2a$", b"$2b$", b"$2y$")) and hash_rounds(password) is not None
+
+
+def _import_batch(db, hasher, batch, rounds):
+    # Records either carry a ready bcrypt hash or a rhythm pattern that still
+    # has to be hashed; the latter are hashed together across the pool
+    to_hash = [i for i, (_, _, password, _) in enumerate(batch) if password is None]
+    if to_hash:
+        hashed = hasher.hash_many([batch[i][3] for i in to_hash], rounds=rounds)
+        for i, hashed_password in zip(to_hash, hashed):
+            username, email, _, pattern = batch[i]
+            batch[i] = (username, email, rhythm.stored_hash(hashed_password), pattern)
+    return db.add_users_bulk([(username, email, password) for username, email, password, _ in batch])
+
+
+@users_cli.command("import")
+@click.argument("file", type=click.File("r", encoding="utf-8"))
+@click.option("--format", "fmt", type=click.Choice(["ndjson", "csv"]), help="Defaults to the file extension.")
+@click.option("--batch-size", default=5000, show_default=True, help="Rows per transaction.")
+@click.option("--rounds", type=int, help="bcrypt cost for rhythm patterns (defaults to the calibrated cost).")
+def import_users(file, fmt, batch_size, rounds):
+    """Import users from an NDJSON or CSV file ('-' for stdin).
+
+    Each record needs username and email, plus either password (a hash
+    exported by 'flask users export' or a plain bcrypt hash of the note
+    names) or rhythmPattern (hashed during import).
+    """
+    db = current_app.extensions["db"]
+    hasher = current_app.extensions["hasher"]
+    fmt = _detect_format(file, fmt)
+
+    read = inserted = invalid = 0
+    batch = []
+    start = time.perf_counter()
+
+    def flush():
+        nonlocal inserted
+        inserted += _import_batch(db, hasher, batch, rounds)
+        batch.clear()
+        elapsed = time.perf_counter() - start
+        click.echo(f"{read} read, {inserted} inserted ({read / elapsed:,.0f} rows/s)", err=True)
+
+    for record in _read_records(file, fmt):
+        read += 1
+        if record is None:
+            invalid += 1
+            continue
+        username = record.get("username")
+        email = record.get("email")
+        password = record.get("password")
+        pattern = record.get("rhythmPattern")
+        if not username or not email or not (password or pattern):
+            invalid += 1
+            continue
+        if not isinstance(username, str) or not isinstance(email, str) or (password and not isinstance(password, str)):
+            invalid += 1
+            continue
+        if password:
+            password = password.encode("utf-8")
+            if not _valid_hash(password):
+                invalid += 1
+                continue
+            batch.append((username, email, password, None))
+        else:
+            try:
+                batch.append((username, email, None, rhythm.parse(pattern)))
+            except rhythm.RhythmError:
+                invalid += 1
+                continue
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+
+    elapsed = time.perf_counter() - start
+    duplicates = read - invalid - inserted
+    click.echo(
+        f"Imported {inserted} users in {elapsed:.2f}s ({read / max(elapsed, 1e-9):,.0f} rows/s); "
+        f"{duplicates} duplicates skipped, {invalid} invalid records"
+    )
+
+
+@users_cli.command("export")
+@click.argument("file", type=click.File("w", encoding="utf-8"), default="-")
+@click.option("--format", "fmt", type=click.Choice(["ndjson", "csv"]), help="Defaults to the file extension.")
+@click.option("--batch-size", default=5000, show_default=True, help="Rows fetched per query.")
+def export_users(file, fmt, batch_size):
+    """Export users (with password hashes) to NDJSON or CSV ('-' for stdout)."""
+    db = current_app.extensions["db"]
+    fmt = _detect_format(file, fmt)
+
+    writer = None
+    if fmt == "csv":
+        writer = csv.writer(file)
+        writer.writerow(["id", "username", "email", "password"])
+
+    count = 0
+    start = time.perf_counter()
+    for user_id, username, email, password in db.iter_users(batch_size):
+        if isinstance(password, bytes):
+            password = password.decode("utf-8")
+        if writer:
+            writer.writerow([user_id, username, email, password])
+        else:
+            file.write(json.dumps({"id": user_id, "username": username, "email": email, "password": password}) + "\n")
+        count += 1
+
+    elapsed = time.perf_counter() - start
+    click.echo(f"Exported {count} users in {elapsed:.2f}s ({count / max(elapsed, 1e-9):,.0f} rows/s)", err=True)
+
+
+@users_cli.command("reshard")
+@click.argument("source", type=click.Path(exists=True))
+@click.argument("destination", type=click.Path())
+@click.option("--shards", type=int, required=True, help="Number of shard files to create.")
+@click.option("--batch-size", default=5000, show_default=True, help="Rows copied per transaction.")
+def reshard(source, destination, shards, batch_size):
+    """Copy every user from SOURCE into a new sharded DESTINATION directory.
+
+    SOURCE is a single database file such as database.db or an existing
+    shard directory. User ids, session generations and revoked refresh
+    tokens are kept, so issued tokens stay valid and signed-out ones stay
+    signed out.
+    """
+    if os.path.exists(os.path.join(destination, "index.db")):
+        raise click.ClickException(f"{destination} already holds a sharded database")
+    src = ShardedDatabase(source) if os.path.isdir(source) else Database(source)
+    dest = ShardedDatabase(destination, shards)
+
+    copied = 0
+    start = time.perf_counter()
+    for rows in _batches(src.iter_users(batch_size), batch_size):
+        copied += dest.add_users_bulk(rows, with_ids=True)
+
+    # Tokens are checked against these, so dropping them would let refresh
+    # tokens issued before a password change, or already used, work again
+    generations = revoked = 0
+    for rows in _batches(src.iter_session_generations(batch_size), batch_size):
+        dest.add_session_state_bulk(rows, [])
+        generations += len(rows)
+    for rows in _batches(src.iter_revoked_refresh_tokens(batch_size), batch_size):
+        dest.add_session_state_bulk([], rows)
+        revoked += len(rows)
+    src.close()
+    dest.close()
+
+    elapsed = time.perf_counter() - start
+    click.echo(f"Copied {copied} users into {shards} shards in {elapsed:.2f}s ({copied / max(elapsed, 1e-9):,.0f} rows/s)")
+    click.echo(f"Copied {generations} session generations and {revoked} revoked refresh tokens")
@@ -1,13 +1,91 @@
 import os
 import sqlite3
-import bcrypt
-import threading # Added threading for lock
+import threading
+import time
+import weakref
 import shutil # Added shutil for file operations
-from dotenv import load_dotenv
+from core.db.base import Storage
+from core.db.writer import WriteBatcher
 
-load_dotenv()
-class Database:
-    def __init__(self):
+
+class _ThreadConnection:
+    # One thread's connection. Only that thread's locals refer to it, so it
+    # is closed as soon as the thread exits (or moves to a new connection)
+    __slots__ = ("conn", "pid", "generation", "__weakref__")
+
+    def __init__(self, conn, generation):
+        self.conn = conn
+        self.pid = os.getpid()
+        self.generation = generation
+
+    def close(self):
+        # A connection inherited across a fork belongs to the parent
+        if self.pid == os.getpid():
+            self.conn.close()
+
+    __del__ = close
+
+
+# Changes kept in name_changes; a reader further behind than this rebuilds
+# from the users table instead
+NAME_CHANGES_KEPT = 100000
+
+
+def name_change_log(table):
+    # DDL for name_changes, a log of every username and email written to
+    # `table` (by an insert or a rename, from any process) that readers can
+    # follow by seq. Triggers keep it complete and trim it to the last
+    # NAME_CHANGES_KEPT entries.
+    trim = f"DELETE FROM name_changes WHERE seq <= last_insert_rowid() - {NAME_CHANGES_KEPT};"
+    return (
+        """
+        CREATE TABLE IF NOT EXISTS name_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            email TEXT NOT NULL
+        );
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_name_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO name_changes(username, email) VALUES(new.username, new.email);
+            {trim}
+        END;
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_name_update AFTER UPDATE OF username, email ON {table} BEGIN
+            INSERT INTO name_changes(username, email) VALUES(new.username, new.email);
+            {trim}
+        END;
+        """,
+    )
+
+
+def open_database(lazy=False):
+    # DATABASE_SHARDS > 1 selects the sharded backend, stored in
+    # DATABASE_SHARD_DIR; otherwise everything lives in one file
+    shards = int(os.getenv("DATABASE_SHARDS", 1))
+    if shards > 1:
+        from core.db.sharded import ShardedDatabase
+        return ShardedDatabase(os.getenv("DATABASE_SHARD_DIR", "shards"), shards)
+    return Database(lazy=lazy)
+
+
+class Database(Storage):
+    # Applied to every new connection. WAL lets readers run alongside the
+    # writer, and NORMAL sync is safe in WAL mode while skipping most fsyncs.
+    connection_pragmas = (
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-8000",
+        "PRAGMA mmap_size=67108864",
+        "PRAGMA foreign_keys=ON",
+    )
+    busy_timeout = 5.0
+    cached_statements = 64
+
+    def __init__(self, db_path=None, snapshot_path=None, lazy=False):
+        # lazy=True defers opening the file and running the schema DDL to the
+        # first query, so importing the app stays cheap on a cold start
         self.user_table_create_query = """
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -16,53 +94,236 @@ class Database:
             password BLOB NOT NULL
         );
         """
-        self.lock = threading.Lock() # Initialize lock
-
-        if os.getenv("VERCEL") == "1" or os.getenv("VERCEL") == 1:
-            # Define the path for the writable database in /tmp
-            tmp_db_path = "/tmp/database.db"
-            # Ensure /tmp directory exists
-            os.makedirs(os.path.dirname(tmp_db_path), exist_ok=True)
-
-            # Check if a database.db exists in the root (deployed static file)
-            # and copy it to /tmp if /tmp/database.db doesn't exist yet
-            if not os.path.exists(tmp_db_path) and os.path.exists("database.db"):
-                shutil.copy("database.db", tmp_db_path)
-            
-            self.db_path = tmp_db_path
+        # Session generation per user, bumped to sign out all of a user's
+        # sessions; users without a row are at generation 0
+        self.sessions_table_create_query = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            user_id INTEGER PRIMARY KEY,
+            generation INTEGER NOT NULL
+        );
+        """
+        # Refresh tokens that were used or logged out, until they expire
+        self.revoked_tokens_table_create_query = """
+        CREATE TABLE IF NOT EXISTS revoked_refresh_tokens (
+            jti TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            expires REAL NOT NULL
+        ) WITHOUT ROWID;
+        """
+        self._last_token_sweep = 0.0
+        # All writes go through one writer thread per process, which groups
+        # concurrent writes into a single transaction and commit
+        self.writer = WriteBatcher(
+            self._writer_connect,
+            flush_interval=float(os.getenv("DB_FLUSH_INTERVAL_MS", 1)) / 1000,
+        )
+        # One connection per thread (and per process, so connections opened
+        # before a gunicorn fork are never shared with the children)
+        self._local = threading.local()
+        self._connections = weakref.WeakSet()
+        self._connections_lock = threading.Lock()
+        # Bumped when the file behind db_path changes, so threads reopen
+        self._generation = 0
+        self._ready = False
+        self._ready_lock = threading.RLock()
+
+        if db_path is None:
+            db_path = os.getenv("DATABASE_PATH")
+            snapshot_path = snapshot_path or os.getenv("DATABASE_SNAPSHOT")
+
+        if db_path:
+            self.db_path = db_path
+        elif os.getenv("VERCEL") == "1" or os.getenv("VERCEL") == 1:
+            # Define the path for the writable database in /tmp; the deployed
+            # database.db is read-only and only copied there once something
+            # is written (see _materialize)
+            self.db_path = "/tmp/database.db"
+            snapshot_path = snapshot_path or "database.db"
         else:
             # Use local path for development
             self.db_path = "database.db"
 
-        self.init_db()
+        # A read-only snapshot to serve reads from until the first write.
+        # Not needed once the writable copy exists.
+        self.snapshot_path = None
+        if snapshot_path and not os.path.exists(self.db_path) and os.path.exists(snapshot_path):
+            self.snapshot_path = snapshot_path
+
+        if not lazy:
+            self._materialize()
+            self._ensure_ready()
+
+    def _ensure_ready(self):
+        if self._ready:
+            return
+        with self._ready_lock:
+            if self._ready:
+                return
+            if self.snapshot_path and not self._snapshot_has_schema():
+                self._materialize()
+            elif not self.snapshot_path:
+                self.init_db()
+            self._ready = True
+
+    def _snapshot_has_schema(self):
+        con = self._thread_connection()
+        return con.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='users'").fetchone() is not None
+
+    def _materialize(self):
+        # Copy-on-write: the first write copies the snapshot to db_path and
+        # every thread moves over to the writable copy. Other processes
+        # sharing db_path may get there first, so the copy is made under a
+        # private name and published with os.link, which fails rather than
+        # overwrite a live database that appeared in the meantime.
+        with self._ready_lock:
+            if not self.snapshot_path:
+                return
+            if not os.path.exists(self.db_path):
+                os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+                tmp_path = f"{self.db_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                shutil.copy(self.snapshot_path, tmp_path)
+                try:
+                    os.link(tmp_path, self.db_path)
+                except FileExistsError:
+                    pass
+                finally:
+                    os.remove(tmp_path)
+            self.snapshot_path = None
+            self._generation += 1
+            self.init_db()
 
     def init_db(self):
-        with self.get_db_connection() as con:
-            cur = con.cursor()
-            cur.execute(self.user_table_create_query)
-            con.commit()
+        # Schema and journal mode are properties of the database file, so they
+        # only need to be set up once rather than on every connection
+        con = self._thread_connection()
+        con.execute("PRAGMA journal_mode=WAL")
+        with con:
+            con.execute(self.user_table_create_query)
+            con.execute(self.sessions_table_create_query)
+            con.execute(self.revoked_tokens_table_create_query)
+            con.execute("CREATE INDEX IF NOT EXISTS revoked_refresh_tokens_expires ON revoked_refresh_tokens(expires)")
+            for statement in name_change_log("users"):
+                con.execute(statement)
 
-    def get_db_connection(self):
-        conn = sqlite3.connect(self.db_path, check_same_thread=False)
-        # Ensure the database schema is initialized for every connection
-        # This helps in ephemeral environments where the DB might be new
-        cur = conn.cursor()
-        cur.execute(self.user_table_create_query)
-        conn.commit()
+    def _connect(self, **kwargs):
+        if self.snapshot_path:
+            # The bundled file never changes, so it can be opened without
+            # locking or a journal (and from a read-only directory)
+            path = f"file:{os.path.abspath(self.snapshot_path)}?immutable=1"
+            kwargs["uri"] = True
+        else:
+            path = self.db_path
+        conn = sqlite3.connect(
+            path,
+            timeout=self.busy_timeout,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+            **kwargs,
+        )
+        for pragma in self.connection_pragmas:
+            conn.execute(pragma)
         return conn
 
-    def add_user(self, username, email, hashed_password):
-        with self.lock:
-            with self.get_db_connection() as con:
-                cur = con.cursor()
-                try:
-                    cur.execute("INSERT INTO users(username, email, password) VALUES(?,?,?)", (username, email, hashed_password))
-                    con.commit()
-                    cur.execute("SELECT * FROM users WHERE username=?", (username,))
-                    user = cur.fetchone()
-                    return user
-                except sqlite3.IntegrityError:
-                    return None # User already exists (due to UNIQUE constraint)
+    def _writer_connect(self):
+        self._ensure_ready()
+        self._materialize()
+        return self._connect(isolation_level=None)
+
+    def _thread_connection(self):
+        if self.snapshot_path and os.path.exists(self.db_path):
+            # Another process has made the writable copy; read that instead
+            self._materialize()
+        current = getattr(self._local, "current", None)
+        if current is None or current.pid != os.getpid() or current.generation != self._generation:
+            if current is not None:
+                current.close()
+            current = self._local.current = _ThreadConnection(self._connect(), self._generation)
+            with self._connections_lock:
+                self._connections.add(current)
+        return current.conn
+
+    def get_db_connection(self):
+        # Connections are kept open and reused by the calling thread; sqlite3
+        # caches the compiled statements of each connection, so the fixed
+        # queries below are only prepared once per thread
+        self._ensure_ready()
+        return self._thread_connection()
+
+    def close(self):
+        self.writer.close()
+        with self._connections_lock:
+            connections, self._connections = list(self._connections), weakref.WeakSet()
+        for connection in connections:
+            connection.close()
+        self._local = threading.local()
+
+    def add_user(self, username, email, hashed_password, user_id=None):
+        # user_id is normally assigned by SQLite; the sharded backend passes
+        # the id it reserved in its routing index
+        def insert(con):
+            cur = con.execute("INSERT INTO users(id, username, email, password) VALUES(?,?,?,?)", (user_id, username, email, hashed_password))
+            return (cur.lastrowid, username, email, hashed_password)
+
+        try:
+            return self.writer.submit(insert)
+        except sqlite3.IntegrityError:
+            return None # User already exists (due to UNIQUE constraint)
+
+    def add_users_bulk(self, users, with_ids=False):
+        # Insert many (username, email, hashed_password) rows, or (id,
+        # username, email, hashed_password) rows with with_ids=True, in a
+        # single transaction. Rows that clash with an existing id, username or
+        # email are skipped; returns the number of rows actually inserted.
+        if with_ids:
+            query = "INSERT OR IGNORE INTO users(id, username, email, password) VALUES(?,?,?,?)"
+        else:
+            query = "INSERT OR IGNORE INTO users(username, email, password) VALUES(?,?,?)"
+
+        def insert(con):
+            return con.executemany(query, users).rowcount
+
+        return self.writer.submit(insert)
+
+    def iter_users(self, batch_size=1000, after_id=0):
+        # Walk the table in id order using keyset pagination, so memory use
+        # and per-page cost stay flat however large the table is
+        con = self.get_db_connection()
+        last_id = after_id
+        while True:
+            rows = con.execute("SELECT * FROM users WHERE id > ? ORDER BY id LIMIT ?", (last_id, batch_size)).fetchall()
+            if not rows:
+                return
+            yield from rows
+            last_id = rows[-1][0]
+
+    def count_users(self):
+        return self.get_db_connection().execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def taken(self, username, email):
+        # Both answered from the UNIQUE indexes in one statement
+        row = self.get_db_connection().execute(
+            "SELECT EXISTS(SELECT 1 FROM users WHERE username=?), EXISTS(SELECT 1 FROM users WHERE email=?)",
+            (username, email),
+        ).fetchone()
+        return (bool(row[0]) if username is not None else None, bool(row[1]) if email is not None else None)
+
+    def last_name_change(self):
+        if self.snapshot_path:
+            # Still on the read-only snapshot, which has no log
+            return 0
+        row = self.get_db_connection().execute("SELECT max(seq) FROM name_changes").fetchone()
+        return row[0] or 0
+
+    def name_changes(self, after_seq, limit=5000):
+        # Up to `limit` (seq, username, email) entries after after_seq, oldest
+        # first; None if some of them have been trimmed from the log already
+        if self.snapshot_path:
+            return []
+        con = self.get_db_connection()
+        rows = con.execute("SELECT seq, username, email FROM name_changes WHERE seq > ? ORDER BY seq LIMIT ?", (after_seq, limit)).fetchall()
+        if rows and rows[0][0] > after_seq + 1 and con.execute("SELECT min(seq) FROM name_changes").fetchone()[0] > after_seq + 1:
+            return None
+        return rows
 
     def get_user_by_id(self, id):
         with self.get_db_connection() as con:
@@ -71,42 +332,98 @@ class Database:
             user = cur.fetchone()
             return user
 
+    def _update_user(self, query, params):
+        try:
+            self.writer.submit(lambda con: con.execute(query, params))
+            return True
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return False
+
     def update_user_password(self, user_id, hashed_password):
-        with self.lock:
-            with self.get_db_connection() as con:
-                cur = con.cursor()
-                try:
-                    cur.execute("UPDATE users SET password=? WHERE id=?", (hashed_password, user_id))
-                    con.commit()
-                    return True
-                except sqlite3.Error as e:
-                    print(f"Database error: {e}")
-                    return False
+        return self._update_user("UPDATE users SET password=? WHERE id=?", (hashed_password, user_id))
 
     def update_user_with_password(self, user_id, username, email, hashed_password):
-        with self.lock:
-            with self.get_db_connection() as con:
-                cur = con.cursor()
-                try:
-                    cur.execute("UPDATE users SET username=?, email=?, password=? WHERE id=?", (username, email, hashed_password, user_id))
-                    con.commit()
-                    return True
-                except sqlite3.Error as e:
-                    print(f"Database error: {e}")
-                    return False
+        return self._update_user("UPDATE users SET username=?, email=?, password=? WHERE id=?", (username, email, hashed_password, user_id))
 
     def update_user_without_password(self, user_id, username, email):
-        with self.lock:
-            with self.get_db_connection() as con:
-                cur = con.cursor()
-                try:
-                    cur.execute("UPDATE users SET username=?, email=? WHERE id=?", (username, email, user_id))
-                    con.commit()
-                    return True
-                except sqlite3.Error as e:
-                    print(f"Database error: {e}")
-                    return False
+        return self._update_user("UPDATE users SET username=?, email=? WHERE id=?", (username, email, user_id))
     
+    def session_generation(self, user_id):
+        con = self.get_db_connection()
+        if self.snapshot_path:
+            # Still on the read-only snapshot, so nothing was ever bumped
+            return 0
+        row = con.execute("SELECT generation FROM sessions WHERE user_id=?", (user_id,)).fetchone()
+        return row[0] if row else 0
+
+    def bump_session_generation(self, user_id):
+        # The user's new generation
+        return self.writer.submit(lambda con: con.execute(
+            "INSERT INTO sessions(user_id, generation) VALUES(?, 1) "
+            "ON CONFLICT(user_id) DO UPDATE SET generation=generation+1 RETURNING generation",
+            (user_id,),
+        ).fetchone()[0])
+
+    def revoke_refresh_token(self, user_id, jti, expires):
+        # True if the token had not been revoked yet. Checking and revoking is
+        # one insert, so two workers cannot both exchange the same token.
+        now = time.time()
+        sweep = now - self._last_token_sweep > 60
+        if sweep:
+            self._last_token_sweep = now
+
+        def revoke(con):
+            if sweep:
+                con.execute("DELETE FROM revoked_refresh_tokens WHERE expires <= ?", (now,))
+            return con.execute("INSERT OR IGNORE INTO revoked_refresh_tokens(jti, user_id, expires) VALUES(?,?,?)", (jti, user_id, expires)).rowcount == 1
+
+        return self.writer.submit(revoke)
+
+    def iter_session_generations(self, batch_size=1000):
+        # Every (user_id, generation) row, in user id order
+        if self.snapshot_path:
+            return
+        con = self.get_db_connection()
+        last_id = 0
+        while True:
+            rows = con.execute("SELECT user_id, generation FROM sessions WHERE user_id > ? ORDER BY user_id LIMIT ?", (last_id, batch_size)).fetchall()
+            if not rows:
+                return
+            yield from rows
+            last_id = rows[-1][0]
+
+    def iter_revoked_refresh_tokens(self, batch_size=1000):
+        # Every (jti, user_id, expires) row that has not expired, in jti order
+        if self.snapshot_path:
+            return
+        con = self.get_db_connection()
+        now = time.time()
+        last_jti = ""
+        while True:
+            rows = con.execute(
+                "SELECT jti, user_id, expires FROM revoked_refresh_tokens WHERE jti > ? AND expires > ? ORDER BY jti LIMIT ?",
+                (last_jti, now, batch_size),
+            ).fetchall()
+            if not rows:
+                return
+            yield from rows
+            last_jti = rows[-1][0]
+
+    def add_session_state_bulk(self, generations, revoked):
+        # Copies (user_id, generation) and (jti, user_id, expires) rows from
+        # the two iterators above in one transaction. A generation only ever
+        # moves up, so an existing higher one is kept.
+        def insert(con):
+            con.executemany(
+                "INSERT INTO sessions(user_id, generation) VALUES(?,?) "
+                "ON CONFLICT(user_id) DO UPDATE SET generation=max(generation, excluded.generation)",
+                generations,
+            )
+            con.executemany("INSERT OR IGNORE INTO revoked_refresh_tokens(jti, user_id, expires) VALUES(?,?,?)", revoked)
+
+        self.writer.submit(insert)
+
     def get_user_by_username(self, username):
         with self.get_db_connection() as con:
             cur = con.cursor()
@@ -0,0 +1,78 @@
+class Storage:
+    # The interface the app and the CLI use for user storage. Users are
+    # (id, username, email, password) tuples; usernames and emails are
+    # unique across the whole store.
+    #
+    # Implementations: core.db.Database (one SQLite file) and
+    # core.db.sharded.ShardedDatabase (users spread over several files).
+
+    def add_user(self, username, email, hashed_password):
+        # The new user, or None if the username or email is taken
+        raise NotImplementedError
+
+    def add_users_bulk(self, users, with_ids=False):
+        # Number of rows inserted; clashing rows are skipped
+        raise NotImplementedError
+
+    def iter_users(self, batch_size=1000, after_id=0):
+        # Every user with an id above after_id, in id order
+        raise NotImplementedError
+
+    def count_users(self):
+        raise NotImplementedError
+
+    def taken(self, username, email):
+        # (username is taken, email is taken); None for either is not checked
+        raise NotImplementedError
+
+    def last_name_change(self):
+        # The seq of the latest entry in the name change log, 0 if none
+        raise NotImplementedError
+
+    def name_changes(self, after_seq, limit=5000):
+        # (seq, username, email) for usernames and emails set by an insert or
+        # a rename after after_seq, oldest first; None if that part of the
+        # log is gone
+        raise NotImplementedError
+
+    def get_user_by_id(self, id):
+        raise NotImplementedError
+
+    def get_user_by_username(self, username):
+        raise NotImplementedError
+
+    def update_user_password(self, user_id, hashed_password):
+        raise NotImplementedError
+
+    def update_user_with_password(self, user_id, username, email, hashed_password):
+        raise NotImplementedError
+
+    def update_user_without_password(self, user_id, username, email):
+        raise NotImplementedError
+
+    def session_generation(self, user_id):
+        # Part of every token issued to the user; tokens with an older
+        # generation are no longer accepted
+        raise NotImplementedError
+
+    def bump_session_generation(self, user_id):
+        raise NotImplementedError
+
+    def revoke_refresh_token(self, user_id, jti, expires):
+        # Marks refresh token `jti` of `user_id` used; False if it already was
+        raise NotImplementedError
+
+    def iter_session_generations(self, batch_size=1000):
+        # (user_id, generation) for every user whose generation was bumped
+        raise NotImplementedError
+
+    def iter_revoked_refresh_tokens(self, batch_size=1000):
+        # (jti, user_id, expires) for every revoked refresh token still unexpired
+        raise NotImplementedError
+
+    def add_session_state_bulk(self, generations, revoked):
+        # Stores rows from the two iterators above, e.g. when resharding
+        raise NotImplementedError
+
+    def close(self):
+        pass
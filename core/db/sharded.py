@@ -0,0 +1,232 @@
+import heapq
+import os
+import sqlite3
+
+from core.db import Database, name_change_log
+from core.db.base import Storage
+
+
+class RoutingIndex(Database):
+    # index.db: assigns user ids and keeps usernames and emails globally
+    # unique. Rows are tiny (no password), so the writes every signup has
+    # to make here are much cheaper than the shard writes.
+    def init_db(self):
+        con = self._thread_connection()
+        con.execute("PRAGMA journal_mode=WAL")
+        with con:
+            con.execute("""
+            CREATE TABLE IF NOT EXISTS accounts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT NOT NULL UNIQUE,
+                email TEXT NOT NULL UNIQUE
+            );
+            """)
+            con.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            for statement in name_change_log("accounts"):
+                con.execute(statement)
+
+    def shard_count(self):
+        row = self.get_db_connection().execute("SELECT value FROM meta WHERE key='shards'").fetchone()
+        return int(row[0]) if row else None
+
+    def set_shard_count(self, shards):
+        self.writer.submit(lambda con: con.execute("INSERT OR REPLACE INTO meta(key, value) VALUES('shards', ?)", (str(shards),)))
+
+    def reserve(self, username, email):
+        # The new user id, or None if the username or email is taken
+        try:
+            return self.writer.submit(lambda con: con.execute("INSERT INTO accounts(username, email) VALUES(?,?)", (username, email)).lastrowid)
+        except sqlite3.IntegrityError:
+            return None
+
+    def release(self, *user_ids):
+        self.writer.submit(lambda con: con.executemany("DELETE FROM accounts WHERE id=?", [(user_id,) for user_id in user_ids]))
+
+    def reserve_many(self, users, with_ids=False):
+        # Reserves what it can of (username, email, ...) rows, or (id,
+        # username, email, ...) rows, in one transaction; returns the rows
+        # that got in as (id, username, email, hashed_password)
+        def insert(con):
+            reserved = []
+            for row in users:
+                if with_ids:
+                    cur = con.execute("INSERT OR IGNORE INTO accounts(id, username, email) VALUES(?,?,?)", row[:3])
+                    user_id, username, email, hashed_password = row
+                else:
+                    cur = con.execute("INSERT OR IGNORE INTO accounts(username, email) VALUES(?,?)", row[:2])
+                    username, email, hashed_password = row
+                    user_id = cur.lastrowid
+                if cur.rowcount:
+                    reserved.append((user_id, username, email, hashed_password))
+            return reserved
+
+        return self.writer.submit(insert)
+
+    def rename(self, user_id, username, email):
+        # The previous (username, email), so the rename can be undone; None
+        # if the user is unknown or the new username or email is taken
+        def update(con):
+            previous = con.execute("SELECT username, email FROM accounts WHERE id=?", (user_id,)).fetchone()
+            if previous is not None:
+                con.execute("UPDATE accounts SET username=?, email=? WHERE id=?", (username, email, user_id))
+            return previous
+
+        try:
+            return self.writer.submit(update)
+        except sqlite3.IntegrityError:
+            return None
+
+    def lookup(self, username):
+        row = self.get_db_connection().execute("SELECT id FROM accounts WHERE username=?", (username,)).fetchone()
+        return row[0] if row else None
+
+    def count(self):
+        return self.get_db_connection().execute("SELECT COUNT(*) FROM accounts").fetchone()[0]
+
+    def taken(self, username, email):
+        row = self.get_db_connection().execute(
+            "SELECT EXISTS(SELECT 1 FROM accounts WHERE username=?), EXISTS(SELECT 1 FROM accounts WHERE email=?)",
+            (username, email),
+        ).fetchone()
+        return (bool(row[0]) if username is not None else None, bool(row[1]) if email is not None else None)
+
+
+class ShardedDatabase(Storage):
+    # Users partitioned over `shards` SQLite files by user id, so writes to
+    # different users mostly land on different file locks. Each shard is a
+    # plain Database with its own connections and writer.
+    def __init__(self, directory, shards=None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.index = RoutingIndex(os.path.join(directory, "index.db"))
+
+        existing = self.index.shard_count()
+        if shards is None:
+            shards = existing
+        if shards is None:
+            raise ValueError(f"{directory} is not a sharded database")
+        if existing is None:
+            self.index.set_shard_count(shards)
+        elif existing != shards:
+            raise ValueError(f"{directory} has {existing} shards, not {shards}; reshard it with 'flask users reshard'")
+
+        self.shards = [Database(os.path.join(directory, f"shard-{i}.db")) for i in range(shards)]
+
+    def shard_for(self, user_id):
+        # Ids are handed out sequentially by the index, so taking them modulo
+        # the shard count spreads users (and their writes) evenly
+        return self.shards[user_id % len(self.shards)]
+
+    def add_user(self, username, email, hashed_password):
+        user_id = self.index.reserve(username, email)
+        if user_id is None:
+            return None # User already exists
+        try:
+            return self.shard_for(user_id).add_user(username, email, hashed_password, user_id=user_id)
+        except sqlite3.Error:
+            self.index.release(user_id)
+            raise
+
+    def add_users_bulk(self, users, with_ids=False):
+        by_shard = {}
+        for row in self.index.reserve_many(users, with_ids=with_ids):
+            by_shard.setdefault(row[0] % len(self.shards), []).append(row)
+        batches = list(by_shard.items())
+        inserted = 0
+        for n, (i, rows) in enumerate(batches):
+            shard = self.shards[i]
+            try:
+                count = shard.add_users_bulk(rows, with_ids=True)
+            except sqlite3.Error:
+                # Nothing from this shard on is stored; free their names
+                self.index.release(*(row[0] for _, rows in batches[n:] for row in rows))
+                raise
+            if count < len(rows):
+                # The shard skipped rows whose id it already holds; release
+                # the reservations that did not make it in
+                self.index.release(*(row[0] for row in rows if (shard.get_user_by_id(row[0]) or (None, None))[1] != row[1]))
+            inserted += count
+        return inserted
+
+    def iter_users(self, batch_size=1000, after_id=0):
+        # Each shard is already in id order, so a k-way merge keeps it global
+        return heapq.merge(*(shard.iter_users(batch_size, after_id) for shard in self.shards))
+
+    def count_users(self):
+        return self.index.count()
+
+    def taken(self, username, email):
+        # The routing index holds every username and email
+        return self.index.taken(username, email)
+
+    def last_name_change(self):
+        return self.index.last_name_change()
+
+    def name_changes(self, after_seq, limit=5000):
+        # Every username and email passes through the routing index
+        return self.index.name_changes(after_seq, limit)
+
+    def get_user_by_id(self, id):
+        return self.shard_for(id).get_user_by_id(id)
+
+    def get_user_by_username(self, username):
+        user_id = self.index.lookup(username)
+        if user_id is None:
+            return None
+        return self.shard_for(user_id).get_user_by_id(user_id)
+
+    def update_user_password(self, user_id, hashed_password):
+        return self.shard_for(user_id).update_user_password(user_id, hashed_password)
+
+    def _rename(self, user_id, username, email, update):
+        # Renames in the index first, which checks uniqueness, then runs
+        # `update` on the shard; undoes the index rename if that fails, as
+        # add_user releases its reservation
+        previous = self.index.rename(user_id, username, email)
+        if previous is None:
+            return False
+        try:
+            updated = update(self.shard_for(user_id))
+        except Exception:
+            self.index.rename(user_id, *previous)
+            raise
+        if not updated:
+            self.index.rename(user_id, *previous)
+        return updated
+
+    def update_user_with_password(self, user_id, username, email, hashed_password):
+        return self._rename(user_id, username, email, lambda shard: shard.update_user_with_password(user_id, username, email, hashed_password))
+
+    def update_user_without_password(self, user_id, username, email):
+        return self._rename(user_id, username, email, lambda shard: shard.update_user_without_password(user_id, username, email))
+
+    def session_generation(self, user_id):
+        return self.shard_for(user_id).session_generation(user_id)
+
+    def bump_session_generation(self, user_id):
+        return self.shard_for(user_id).bump_session_generation(user_id)
+
+    def revoke_refresh_token(self, user_id, jti, expires):
+        return self.shard_for(user_id).revoke_refresh_token(user_id, jti, expires)
+
+    def iter_session_generations(self, batch_size=1000):
+        return heapq.merge(*(shard.iter_session_generations(batch_size) for shard in self.shards))
+
+    def iter_revoked_refresh_tokens(self, batch_size=1000):
+        for shard in self.shards:
+            yield from shard.iter_revoked_refresh_tokens(batch_size)
+
+    def add_session_state_bulk(self, generations, revoked):
+        # Each row goes to the shard that owns its user
+        by_shard = {}
+        for row in generations:
+            by_shard.setdefault(row[0] % len(self.shards), ([], []))[0].append(row)
+        for row in revoked:
+            by_shard.setdefault(row[1] % len(self.shards), ([], []))[1].append(row)
+        for i, (shard_generations, shard_revoked) in by_shard.items():
+            self.shards[i].add_session_state_bulk(shard_generations, shard_revoked)
+
+    def close(self):
+        self.index.close()
+        for shard in self.shards:
+            shard.close()
@@ -0,0 +1,161 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+
+class WriteBatcher:
+    # Single writer for one database file per process.
+    #
+    # Callers queue a function that performs their write on the writer's
+    # connection and block on its result. The writer thread takes everything
+    # queued (lingering up to `flush_interval` for more), applies it in one
+    # BEGIN IMMEDIATE transaction and commits once, so concurrent writes
+    # share a single commit. Each write runs inside its own savepoint: a
+    # failing write (e.g. a UNIQUE violation) is rolled back alone and its
+    # exception is raised to its caller only.
+    #
+    # Across gunicorn workers, BEGIN IMMEDIATE takes SQLite's write lock up
+    # front and waits for it through the busy timeout; if the file stays
+    # locked the whole batch is retried with backoff instead of failing
+    # with "database is locked".
+    #
+    # If the writer cannot open its connection, everything queued fails
+    # with that error and the next submit starts a new writer. Any other
+    # unexpected error fails the batch it happened in, and the writer is
+    # replaced with one on a fresh connection. Callers give up after
+    # `timeout` seconds rather than wait on a writer that is stuck.
+    def __init__(self, connect, max_batch=256, flush_interval=0.001, retries=5, timeout=60.0):
+        self.connect = connect
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def submit(self, fn):
+        self._ensure_started()
+        future = Future()
+        self._queue.put((fn, future))
+        if self._thread is None:
+            # The writer failed to start after we checked; whatever it did not
+            # fail before stopping is picked up by the next one
+            self._ensure_started()
+        return future.result(self.timeout)
+
+    def _ensure_started(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                # A forked child inherits the queue object but not the thread
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                self._thread = None
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                self._thread.start()
+
+    def close(self):
+        if self._thread is not None and self._pid == os.getpid():
+            self._queue.put(None)
+            self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        try:
+            con = self.connect()
+        except Exception as e:
+            with self._start_lock:
+                self._thread = None
+            self._fail_queued(e)
+            return
+        try:
+            while True:
+                batch = self._next_batch()
+                if batch is None:
+                    return
+                try:
+                    self._apply(con, batch)
+                except BaseException as e:
+                    # E.g. the ROLLBACK after a failed batch failed too; the
+                    # connection is in an unknown state, so stop using it
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    with self._start_lock:
+                        self._thread = None
+                    if not self._queue.empty():
+                        self._ensure_started()
+                    return
+        finally:
+            con.close()
+
+    def _fail_queued(self, error):
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None:
+                item[1].set_exception(error)
+
+    def _next_batch(self):
+        item = self._queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.max_batch:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if item is None:
+                # Finish this batch, then stop
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _apply(self, con, batch):
+        for attempt in range(self.retries + 1):
+            results = []
+            try:
+                con.execute("BEGIN IMMEDIATE")
+                for fn, future in batch:
+                    con.execute("SAVEPOINT write")
+                    try:
+                        results.append((future, fn(con), None))
+                        con.execute("RELEASE write")
+                    except Exception as e:
+                        con.execute("ROLLBACK TO write")
+                        con.execute("RELEASE write")
+                        results.append((future, None, e))
+                con.execute("COMMIT")
+                break
+            except sqlite3.Error as e:
+                if con.in_transaction:
+                    con.execute("ROLLBACK")
+                if attempt == self.retries:
+                    for _, future in batch:
+                        future.set_exception(e)
+                    return
+                time.sleep(0.01 * 2 ** attempt)
+
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
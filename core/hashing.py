@@ -0,0 +1,175 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+
+class HashingBusy(Exception):
+    # Raised when the admission queue is full; the app turns it into a 503
+    pass
+
+
+# bcrypt is imported where it is used, so processes that never hash (or have
+# not yet) do not pay for loading it at startup
+
+def _hashpw(password, rounds):
+    import bcrypt
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _checkpw(password, hashed_password):
+    import bcrypt
+    return bcrypt.checkpw(password, hashed_password)
+
+
+def hash_rounds(hashed_password):
+    # bcrypt hashes look like $2b$12$<salt+digest>; the cost is the 3rd field
+    if isinstance(hashed_password, str):
+        hashed_password = hashed_password.encode("utf-8")
+    try:
+        return int(hashed_password.split(b"$")[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def calibrate_rounds(target_ms, min_rounds=10, max_rounds=16, probe_rounds=6):
+    # Every extra round doubles the cost, so time one cheap hash and
+    # extrapolate instead of timing the expensive candidates themselves
+    start = time.perf_counter()
+    _hashpw(b"calibration", probe_rounds)
+    probe_ms = (time.perf_counter() - start) * 1000
+
+    rounds = min_rounds
+    while rounds < max_rounds and probe_ms * 2 ** (rounds + 1 - probe_rounds) <= target_ms:
+        rounds += 1
+    return rounds
+
+
+def default_workers():
+    # One pool process per core, or 0 (hash inline) where a forkserver pool
+    # cannot run: Windows has no forkserver, and Vercel functions run on AWS
+    # Lambda, which has no /dev/shm for the pool's semaphores
+    if os.getenv("VERCEL") == "1" or "forkserver" not in multiprocessing.get_all_start_methods():
+        return 0
+    return os.cpu_count() or 1
+
+
+class Hasher:
+    # Runs bcrypt in a pool of BCRYPT_WORKERS processes (default: see
+    # default_workers), or inline in the calling thread with 0. Every
+    # gunicorn worker has its own pool, so a server runs up to gunicorn
+    # workers x BCRYPT_WORKERS hashing processes; size one of the two down
+    # when running several workers per host.
+    def __init__(self, workers=None, queue_size=None, rounds=None, target_ms=None, lazy=False):
+        # lazy=True postpones calibrating the cost to the first hash
+        if workers is None:
+            workers = int(os.getenv("BCRYPT_WORKERS", default_workers()))
+        if queue_size is None:
+            queue_size = int(os.getenv("BCRYPT_QUEUE_SIZE", workers * 4 or 4))
+        if rounds is None and os.getenv("BCRYPT_ROUNDS"):
+            rounds = int(os.getenv("BCRYPT_ROUNDS"))
+        if target_ms is None:
+            target_ms = float(os.getenv("BCRYPT_TARGET_MS", 250))
+
+        self.workers = workers
+        self.queue_size = queue_size
+        self.target_ms = target_ms
+        self._rounds = rounds
+        self._rounds_lock = threading.Lock()
+        if not lazy:
+            self.rounds
+
+        # Hashes waiting for or running in the pool. Admission is refused
+        # instead of queueing without bound so a login burst cannot tie up
+        # every web worker thread behind bcrypt.
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self._pool = None
+        self._pool_pid = None
+        self._pool_lock = threading.Lock()
+
+    @property
+    def rounds(self):
+        if self._rounds is None:
+            with self._rounds_lock:
+                if self._rounds is None:
+                    self._rounds = calibrate_rounds(self.target_ms)
+        return self._rounds
+
+    @property
+    def queue_depth(self):
+        return self._pending
+
+    def _get_pool(self):
+        # Created lazily and per process, so a pool is never inherited
+        # across a gunicorn fork. Its processes come from a forkserver rather
+        # than a fork of this one, whose other threads (the db writer, the
+        # availability index) could be holding locks a forked child would
+        # then wait on forever. None means hash inline: workers is 0, or
+        # the pool could not be created here.
+        with self._pool_lock:
+            if self.workers <= 0:
+                return None
+            if self._pool is None or self._pool_pid != os.getpid():
+                try:
+                    context = multiprocessing.get_context("forkserver")
+                    # Preload what the workers need rather than the default,
+                    # the __main__ module. Like any spawned process, each
+                    # worker still imports __main__ as __mp_main__, so a
+                    # script that starts a server must do it under
+                    # `if __name__ == "__main__"`, as app.py does.
+                    context.set_forkserver_preload(["core.hashing", "bcrypt"])
+                    self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+                except (ValueError, OSError, ImportError) as e:
+                    print(f"bcrypt pool unavailable, hashing inline: {e}")
+                    self.workers = 0
+                    self._pool = None
+                    return None
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy()
+        with self._pending_lock:
+            self._pending += 1
+        try:
+            pool = self._get_pool()
+            if pool is None:
+                return fn(*args)
+            return pool.submit(fn, *args).result()
+        finally:
+            with self._pending_lock:
+                self._pending -= 1
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(_hashpw, password, self.rounds)
+
+    def hash_many(self, passwords, rounds=None):
+        # For offline tools such as bulk import: spreads a batch across the
+        # pool and bypasses the admission queue used for web requests
+        rounds = rounds or self.rounds
+        pool = self._get_pool()
+        if pool is None:
+            return [_hashpw(password, rounds) for password in passwords]
+        chunksize = max(1, len(passwords) // (self.workers * 4))
+        return list(pool.map(_hashpw, passwords, repeat(rounds), chunksize=chunksize))
+
+    def check(self, password, hashed_password):
+        if isinstance(hashed_password, str):
+            hashed_password = hashed_password.encode("utf-8")
+        return self._run(_checkpw, password, hashed_password)
+
+    def needs_rehash(self, hashed_password):
+        rounds = hash_rounds(hashed_password)
+        return rounds is None or rounds < self.rounds
+
+    def shutdown(self):
+        with self._pool_lock:
+            if self._pool is not None and self._pool_pid == os.getpid():
+                self._pool.shutdown()
+            self._pool = None
@@ -0,0 +1,298 @@
+import bisect
+import functools
+import glob
+import hmac
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+from flask import Response, request
+
+# Seconds; fixed so histograms from different workers can simply be added
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, counts=None, total=0.0):
+        self.counts = counts or [0] * (len(BUCKETS) + 1)
+        self.total = total
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.total += value
+
+
+@functools.lru_cache(maxsize=1024)
+def _labels(**labels):
+    return ",".join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+
+
+class Metrics:
+    # Request phase timers and histograms for the /metrics endpoint.
+    #
+    # Every request records how long it spent in each phase (jwt, db,
+    # bcrypt, render). With METRICS_DIR set, each process periodically
+    # writes a snapshot there and /metrics adds up the snapshots of all
+    # gunicorn workers; otherwise only the current process is reported.
+    # Like Prometheus' multiprocess mode, the directory should be emptied
+    # whenever the server is (re)started.
+    #
+    # /metrics is only served when a `token` is configured, to scrapers that
+    # send it as "Authorization: Bearer <token>".
+    def __init__(self, enabled=True, directory=None, flush_interval=1.0, slow_request_ms=None, token=None):
+        self.enabled = enabled
+        self.token = token
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.slow_request_ms = slow_request_ms
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._last_flush = time.monotonic()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def from_env(cls):
+        slow = os.getenv("SLOW_REQUEST_MS")
+        return cls(
+            enabled=os.getenv("METRICS", "1") != "0",
+            directory=os.getenv("METRICS_DIR"),
+            slow_request_ms=float(slow) if slow else None,
+            token=os.getenv("METRICS_TOKEN") or None,
+        )
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            self._observe(name, labels, value)
+
+    def _observe(self, name, labels, value):
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = Histogram()
+        histogram.observe(value)
+
+    def inc(self, name, labels, amount=1):
+        with self._lock:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0) + amount
+
+    def gauge(self, name, fn):
+        # `fn` is called whenever a snapshot is taken
+        self.gauges[name] = fn
+
+    # Phases
+
+    def phase(self, name):
+        return _Phase(self, name) if self.enabled else _NO_PHASE
+
+    def _add_phase(self, name, elapsed):
+        phases = getattr(self._local, "phases", None)
+        if phases is not None:
+            phases[name] = phases.get(name, 0.0) + elapsed
+            self._local.phased += elapsed
+
+    def _phased(self):
+        # Time attributed to any phase so far in this request
+        return getattr(self._local, "phased", 0.0)
+
+    def instrument(self, obj, methods, phase, metric):
+        # Wrap methods of `obj` in place so every call is timed into
+        # `phase` and into a per-method histogram
+        if not self.enabled:
+            return
+        for method in methods:
+            original = getattr(obj, method)
+
+            @functools.wraps(original)
+            def timed(*args, _original=original, _method_labels=_labels(method=method), **kwargs):
+                start = time.perf_counter()
+                try:
+                    return _original(*args, **kwargs)
+                finally:
+                    elapsed = time.perf_counter() - start
+                    self._add_phase(phase, elapsed)
+                    self.observe(metric, _method_labels, elapsed)
+
+            setattr(obj, method, timed)
+
+    # Requests
+
+    def init_app(self, app):
+        if not self.enabled:
+            return
+        self.logger = app.logger
+        self.gauge("snapbeat_requests_in_flight", lambda: self.in_flight)
+        app.before_request(self._start_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+        # Time rendering in the template class itself; Flask's render
+        # signals cost more than the measurement when they have receivers
+        metrics = self
+
+        class TimedTemplate(app.jinja_env.template_class):
+            def render(self, *args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return super().render(*args, **kwargs)
+                finally:
+                    metrics._add_phase("render", time.perf_counter() - start)
+
+        app.jinja_env.template_class = TimedTemplate
+
+    def _start_request(self):
+        with self._lock:
+            self.in_flight += 1
+        self._local.phases = {}
+        self._local.phased = 0.0
+        self._local.start = time.perf_counter()
+        self._local.status = None
+
+    def _after_request(self, response):
+        self._local.status = response.status_code
+        return response
+
+    def _teardown_request(self, exc):
+        phases = getattr(self._local, "phases", None)
+        if phases is None:
+            return
+        elapsed = time.perf_counter() - self._local.start
+        status = self._local.status or 500
+        endpoint = request.endpoint or "none"
+        self._local.phases = None
+
+        with self._lock:
+            self.in_flight -= 1
+            self._observe("snapbeat_request_duration_seconds", _labels(endpoint=endpoint), elapsed)
+            key = ("snapbeat_requests_total", _labels(endpoint=endpoint, status=status))
+            self.counters[key] = self.counters.get(key, 0) + 1
+            for name, seconds in phases.items():
+                self._observe("snapbeat_request_phase_seconds", _labels(phase=name), seconds)
+
+        if self.slow_request_ms is not None and elapsed * 1000 >= self.slow_request_ms:
+            breakdown = " ".join(f"{name}={seconds * 1000:.1f}ms" for name, seconds in sorted(phases.items()))
+            other = elapsed - sum(phases.values())
+            self.logger.warning(
+                "slow request %s %s -> %s in %.1fms (%s other=%.1fms)",
+                request.method, request.path, status, elapsed * 1000, breakdown, other * 1000,
+            )
+
+        if self.directory and time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    # Export
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "pid": os.getpid(),
+                "histograms": [[name, labels, h.counts[:], h.total] for (name, labels), h in self.histograms.items()],
+                "counters": [[name, labels, value] for (name, labels), value in self.counters.items()],
+                "gauges": {name: fn() for name, fn in self.gauges.items()},
+            }
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path + ".tmp", path)
+
+    def _snapshots(self):
+        if not self.directory:
+            return [self.snapshot()]
+        self.flush()
+        snapshots = []
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    def render(self):
+        histograms = {}
+        counters = {}
+        gauges = {}
+        for snapshot in self._snapshots():
+            for name, labels, counts, total in snapshot["histograms"]:
+                merged = histograms.setdefault((name, labels), Histogram())
+                merged.counts = [a + b for a, b in zip(merged.counts, counts)]
+                merged.total += total
+            for name, labels, value in snapshot["counters"]:
+                counters[(name, labels)] = counters.get((name, labels), 0) + value
+            # Counters of exited workers still count; their gauges do not
+            if _alive(snapshot["pid"]):
+                for name, value in snapshot["gauges"].items():
+                    gauges[name] = gauges.get(name, 0) + value
+
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE {name} counter")
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{{{labels}}} {value}")
+        for name, value in sorted(gauges.items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (metric, labels), histogram in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                prefix = labels + "," if labels else ""
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+                lines.append(f"{name}_sum{{{labels}}} {histogram.total}")
+                lines.append(f"{name}_count{{{labels}}} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def response(self):
+        if not self.token:
+            return Response("Not Found", 404, mimetype="text/plain")
+        scheme, _, credentials = request.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() != "bearer" or not hmac.compare_digest(credentials.encode("utf-8"), self.token.encode("utf-8")):
+            return Response("Unauthorized", 401, {"WWW-Authenticate": "Bearer"}, mimetype="text/plain")
+        return Response(self.render(), mimetype="text/plain; version=0.0.4")
+
+
+class _Phase:
+    # A plain class is noticeably cheaper per use than @contextmanager.
+    # Time spent in other phases inside this one (e.g. the db lookups of a
+    # token refresh in "jwt") is left to them, so phases never overlap.
+    __slots__ = ("metrics", "name", "start", "nested")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.nested = self.metrics._phased()
+
+    def __exit__(self, *exc):
+        nested = self.metrics._phased() - self.nested
+        self.metrics._add_phase(self.name, time.perf_counter() - self.start - nested)
+
+
+_NO_PHASE = nullcontext()
+
+
+def _alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
@@ -0,0 +1,69 @@
+import json
+
+# The on-screen keyboard (static/*.js): key letter -> note name
+KEY_NOTES = {
+    "Q": "C4", "W": "C#4", "E": "D4", "R": "D#4",
+    "T": "E4", "Y": "F4", "U": "F#4", "I": "G4",
+}
+
+# bcrypt ignores everything past 72 bytes, and each beat encodes to one byte
+MAX_BEATS = 72
+# Generous for MAX_BEATS beats of {"key":..,"note":..,"time":..} objects
+MAX_PATTERN_BYTES = 8192
+
+# Canonical encoding: one byte per beat, the ASCII key letter of its note
+_NOTE_CODES = {note: ord(key) for key, note in KEY_NOTES.items()}
+_CODE_NOTES = {ord(key): note.encode("ascii") for key, note in KEY_NOTES.items()}
+
+# Stored hashes of canonically encoded patterns carry this prefix. Hashes
+# without it were made from the concatenated note names and are upgraded
+# on the next successful login.
+HASH_PREFIX = b"r1"
+
+
+class RhythmError(ValueError):
+    pass
+
+
+def parse(raw):
+    # Validate a rhythm pattern and return its canonical encoding. `raw` is
+    # the JSON text posted by the forms or an already decoded list of beats;
+    # oversized input is rejected before it is decoded.
+    if isinstance(raw, (str, bytes)):
+        if len(raw) > MAX_PATTERN_BYTES:
+            raise RhythmError("Rhythm pattern is too large.")
+        try:
+            beats = json.loads(raw)
+        except ValueError:
+            raise RhythmError("Rhythm pattern is not valid JSON.")
+    else:
+        beats = raw
+
+    if not isinstance(beats, list) or not beats:
+        raise RhythmError("Rhythm pattern is empty.")
+    if len(beats) > MAX_BEATS:
+        raise RhythmError(f"Rhythm pattern is longer than {MAX_BEATS} beats.")
+    try:
+        return bytes([_NOTE_CODES[beat["note"]] for beat in beats])
+    except (KeyError, TypeError):
+        raise RhythmError("Rhythm pattern contains an unknown note.")
+
+
+def legacy_password(encoded):
+    # The password the routes used to build: the note names concatenated,
+    # cut at bcrypt's 72 byte limit like older bcrypt versions did silently
+    return b"".join(_CODE_NOTES[code] for code in encoded)[:72]
+
+
+def stored_hash(hashed_password):
+    return HASH_PREFIX + hashed_password
+
+
+def credentials(encoded, stored):
+    # (password, bcrypt_hash, is_legacy) for checking `encoded` against a
+    # stored hash of either format
+    if isinstance(stored, str):
+        stored = stored.encode("utf-8")
+    if stored.startswith(HASH_PREFIX):
+        return encoded, stored[len(HASH_PREFIX):], False
+    return legacy_password(encoded), stored, True
@@ -0,0 +1,138 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+
+class MemoryBucketStore:
+    # Token buckets for one process, split across lock-striped shards so
+    # concurrent requests for different keys rarely contend on a lock.
+    def __init__(self, shards=64, sweep_interval=60.0):
+        self._shards = [({}, threading.Lock()) for _ in range(shards)]
+        self._last_sweep = [time.monotonic()] * shards
+        self.sweep_interval = sweep_interval
+
+    def take(self, key, rate, burst):
+        # Returns 0 when a token was taken, otherwise the seconds until one
+        # will be available
+        index = hash(key) % len(self._shards)
+        buckets, lock = self._shards[index]
+        now = time.monotonic()
+        with lock:
+            if now - self._last_sweep[index] > self.sweep_interval:
+                self._sweep(buckets, now)
+                self._last_sweep[index] = now
+            tokens, updated, _ = buckets.get(key, (burst, now, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+            return wait
+
+    def peek(self, key, rate, burst):
+        # Like take(), without taking the token
+        buckets, lock = self._shards[hash(key) % len(self._shards)]
+        now = time.monotonic()
+        with lock:
+            tokens, updated, _ = buckets.get(key, (burst, now, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        return 0 if tokens >= 1 else (1 - tokens) / rate
+
+    def _sweep(self, buckets, now):
+        # A bucket left alone until it refilled completely is no different
+        # from a missing one, so idle buckets are simply dropped
+        for key in [key for key, (_, _, full_at) in buckets.items() if full_at <= now]:
+            del buckets[key]
+
+
+class SQLiteBucketStore:
+    # Token buckets in a small SQLite file, shared by every gunicorn worker
+    # on the host. State is disposable, so durability is traded for speed.
+    def __init__(self, path=None, sweep_interval=60.0):
+        self.path = path or os.path.join(tempfile.gettempdir(), "snapbeat-throttle.db")
+        self.sweep_interval = sweep_interval
+        self._local = threading.local()
+        self._last_sweep = time.time()
+        con = self._connection()
+        con.execute("PRAGMA journal_mode=WAL")
+        with con:
+            con.execute("""
+            CREATE TABLE IF NOT EXISTS buckets (
+                key TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated REAL NOT NULL,
+                full_at REAL NOT NULL
+            ) WITHOUT ROWID
+            """)
+            con.execute("CREATE INDEX IF NOT EXISTS buckets_full_at ON buckets(full_at)")
+
+    def _connection(self):
+        con = getattr(self._local, "conn", None)
+        if con is None or self._local.pid != os.getpid():
+            con = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            con.execute("PRAGMA synchronous=OFF")
+            self._local.conn = con
+            self._local.pid = os.getpid()
+        return con
+
+    def take(self, key, rate, burst):
+        con = self._connection()
+        now = time.time()
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            row = con.execute("SELECT tokens, updated FROM buckets WHERE key=?", (key,)).fetchone()
+            tokens, updated = row if row else (burst, now)
+            tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            full_at = now + (burst - tokens) / rate
+            con.execute("INSERT OR REPLACE INTO buckets(key, tokens, updated, full_at) VALUES(?,?,?,?)", (key, tokens, now, full_at))
+            if now - self._last_sweep > self.sweep_interval:
+                self._last_sweep = now
+                con.execute("DELETE FROM buckets WHERE full_at <= ?", (now,))
+            con.execute("COMMIT")
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+        return wait
+
+
+    def peek(self, key, rate, burst):
+        now = time.time()
+        row = self._connection().execute("SELECT tokens, updated FROM buckets WHERE key=?", (key,)).fetchone()
+        tokens, updated = row if row else (burst, now)
+        tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+        return 0 if tokens >= 1 else (1 - tokens) / rate
+
+
+class Throttle:
+    # A token bucket per key: `per_minute` sustained, bursts up to `burst`.
+    # per_minute=0 disables the throttle. `store` is anything with the
+    # take(key, rate, burst) and peek(key, rate, burst) methods of the
+    # bucket stores above.
+    def __init__(self, store, per_minute, burst=None, prefix=""):
+        self.store = store
+        self.rate = per_minute / 60.0
+        self.burst = burst or per_minute
+        self.prefix = prefix
+
+    def hit(self, key):
+        if not self.rate:
+            return 0
+        return self.store.take(self.prefix + str(key), self.rate, self.burst)
+
+    def check(self, key):
+        # The wait hit() would return, without spending a token; for limits
+        # that only charge some outcomes (e.g. failed logins)
+        if not self.rate:
+            return 0
+        return self.store.peek(self.prefix + str(key), self.rate, self.burst)
+
+
+def store_from_env():
+    if os.getenv("THROTTLE_STORE", "memory") == "sqlite":
+        return SQLiteBucketStore(os.getenv("THROTTLE_PATH"))
+    return MemoryBucketStore()
@@ -0,0 +1,149 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
+
+import jwt
+
+from core.cache import UserCache
+
+ACCESS_COOKIE = "token"
+REFRESH_COOKIE = "refresh"
+
+
+class Revocations:
+    # Revoked token ids and (user id, generation) pairs. An entry is only
+    # kept until every token it can match would have expired anyway, so the
+    # set stays as small as the number of recent logouts.
+    def __init__(self, sweep_interval=60.0):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.time()
+        self.sweep_interval = sweep_interval
+
+    def add(self, key, until):
+        now = time.time()
+        with self._lock:
+            self._entries[key] = max(until, self._entries.get(key, 0))
+            if now - self._last_sweep > self.sweep_interval:
+                self._entries = {k: t for k, t in self._entries.items() if t > now}
+                self._last_sweep = now
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class TokenService:
+    # Sessions are a short-lived access token, whose claims (id, username,
+    # email) are enough to render pages without a database lookup, and a
+    # long-lived refresh token that is exchanged for a new pair when the
+    # access token has expired. Refresh tokens are single use: exchanging
+    # or logging out one revokes it in the database, and it is checked
+    # against the user's current session generation there, which a
+    # password change bumps.
+    #
+    # Verified access tokens are remembered by digest, so a repeat request
+    # costs a hash and a dict lookup instead of an HMAC and claim checks.
+    # Access token revocations (logout, password change) live in this
+    # process only; other gunicorn workers keep accepting an access token
+    # until it expires, which is what access_ttl bounds.
+    def __init__(self, secret, db, access_ttl=None, refresh_ttl=None, cache_size=None):
+        if access_ttl is None:
+            access_ttl = int(os.getenv("ACCESS_TOKEN_TTL", 15 * 60))
+        if refresh_ttl is None:
+            refresh_ttl = int(os.getenv("REFRESH_TOKEN_TTL", 30 * 24 * 3600))
+        if cache_size is None:
+            cache_size = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
+        self.secret = secret
+        self.db = db
+        self.access_ttl = access_ttl
+        self.refresh_ttl = refresh_ttl
+        self.verified = UserCache(max_entries=cache_size, ttl=access_ttl)
+        self.revoked = Revocations()
+
+    def issue(self, user_id, username, email, gen):
+        # (access token, refresh token)
+        now = int(time.time())
+        access = jwt.encode({
+            "typ": "access", "jti": uuid.uuid4().hex, "iat": now, "exp": now + self.access_ttl,
+            "id": user_id, "username": username, "email": email, "gen": gen,
+        }, self.secret, algorithm="HS256")
+        refresh = jwt.encode({
+            "typ": "refresh", "jti": uuid.uuid4().hex, "iat": now, "exp": now + self.refresh_ttl,
+            "id": user_id, "gen": gen,
+        }, self.secret, algorithm="HS256")
+        return access, refresh
+
+    def _decode(self, token, typ):
+        try:
+            claims = jwt.decode(token, self.secret, algorithms=["HS256"], options={"require": ["exp", "jti"]})
+        except jwt.InvalidTokenError:
+            return None
+        return claims if claims.get("typ") == typ else None
+
+    def _is_revoked(self, claims):
+        return ("jti", claims["jti"]) in self.revoked or ("gen", claims["id"], claims["gen"]) in self.revoked
+
+    def verify_access(self, token):
+        # The token's claims, or None if it is invalid, expired or revoked
+        digest = hashlib.blake2b(token.encode("utf-8"), digest_size=16).digest()
+        claims = self.verified.get(digest)
+        if claims is None:
+            claims = self._decode(token, "access")
+            if claims is None:
+                return None
+            self.verified.put(digest, claims)
+        elif claims["exp"] <= time.time():
+            return None
+        if self._is_revoked(claims):
+            return None
+        return claims
+
+    def refresh(self, token):
+        # The user's current row for a usable refresh token, which is retired
+        # so it cannot be exchanged twice; None otherwise
+        claims = self._decode(token, "refresh")
+        if claims is None:
+            return None
+        user = self.db.get_user_by_id(claims["id"])
+        if not user or self.db.session_generation(user[0]) != claims["gen"]:
+            return None
+        if not self.db.revoke_refresh_token(user[0], claims["jti"], claims["exp"]):
+            return None
+        return user
+
+    def revoke(self, token):
+        # Retires one access or refresh token, e.g. on logout
+        if not token:
+            return
+        try:
+            claims = jwt.decode(token, self.secret, algorithms=["HS256"], options={"verify_exp": False})
+        except jwt.InvalidTokenError:
+            return
+        if "jti" not in claims or "exp" not in claims:
+            return
+        if claims.get("typ") == "refresh":
+            self.db.revoke_refresh_token(claims["id"], claims["jti"], claims["exp"])
+        else:
+            self.revoked.add(("jti", claims["jti"]), claims["exp"])
+
+    def revoke_generation(self, user_id, gen):
+        # Retires every token of `user_id` issued for generation `gen`;
+        # refresh tokens are already refused by the database check, so only
+        # access tokens need remembering
+        self.revoked.add(("gen", user_id, gen), time.time() + self.access_ttl)
+
+    def set_cookies(self, response, user_id, username, email, gen):
+        access, refresh = self.issue(user_id, username, email, gen)
+        response.set_cookie(ACCESS_COOKIE, access, max_age=self.access_ttl, httponly=True, samesite="Lax")
+        response.set_cookie(REFRESH_COOKIE, refresh, max_age=self.refresh_ttl, httponly=True, samesite="Lax")
+        return response
+
+    def delete_cookies(self, response):
+        response.delete_cookie(ACCESS_COOKIE)
+        response.delete_cookie(REFRESH_COOKIE)
+        return response
@@ -79,6 +79,30 @@ function updateRhythmDisplay() {
     }
 }
 
+// Check a username or email against /auth/available as it is typed
+function watchAvailability(input, field, message) {
+    let timer;
+    input.addEventListener('input', function() {
+        clearTimeout(timer);
+        input.setCustomValidity('');
+        const value = input.value.trim();
+        if (!value) {
+            return;
+        }
+        timer = setTimeout(() => {
+            fetch(`/auth/available?${field}=${encodeURIComponent(value)}`)
+                .then(response => response.ok ? response.json() : null)
+                .then(result => {
+                    if (result && input.value.trim() === value) {
+                        input.setCustomValidity(result[field] ? '' : message);
+                        input.reportValidity();
+                    }
+                })
+                .catch(() => {});
+        }, 300);
+    });
+}
+
 // Event listeners
 document.addEventListener('DOMContentLoaded', function() {
     const recordBtn = document.getElementById('recordBtn');
@@ -88,6 +112,9 @@ document.addEventListener('DOMContentLoaded', function() {
     const submitBtn = document.getElementById('submitBtn');
     const signupForm = document.getElementById('signupForm');
 
+    watchAvailability(document.getElementById('username'), 'username', 'This username is already taken.');
+    watchAvailability(document.getElementById('email'), 'email', 'An account with this email already exists.');
+
     // Keyboard event listeners
     document.addEventListener('keydown', function(e) {
         // Check if the active element is an input field